@@ -7,26 +7,875 @@
     author: lwb@fronware
 """
 
-from time import time
+from time import time, sleep
 from copy import deepcopy, copy
 # from threading import Lock
-from threading import local
+from threading import Lock, Condition, local
+from contextlib import contextmanager
 import warnings
 import traceback
 import sqlite3
+import heapq
+import bisect
+import weakref
+import sys
+import os
+import tempfile
+import operator
+from collections import OrderedDict
+from functools import wraps
+from itertools import izip, islice
+
+from .thread_util import mthread_safe, make_thread, RWLock, Future, ThreadPool
 
-from .thread_util import mthread_safe
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+#####################
+# background maintenance
+#####################
+
+class Maintainer(object):
+    """
+        A daemon thread which maintains registered caches,
+        so that API calls of these caches never pay for maintenance.
+        each cache is maintained by `maintain_step(budget)`,
+        which works in small slices and returns True if there's more to do.
+    """
+
+    def __init__(self, interval=0.1, budget=0.005):
+        """
+            input:
+                interval -> seconds to sleep when all caches are maintained.
+                budget -> seconds spent on each cache per round.
+        """
+        self.interval = interval
+        self.budget = budget
+        self.caches = weakref.WeakSet()
+        self._lock = Lock()
+        self._thread = None
+
+    def register(self, cache):
+        with self._lock:
+            self.caches.add(cache)
+            if self._thread is None:
+                self._thread = make_thread(self._run, name='cache-maintainer', daemon=True)
+
+    def unregister(self, cache):
+        with self._lock:
+            self.caches.discard(cache)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                caches = list(self.caches)
+                if not caches:
+                    self._thread = None
+                    return
+
+            more = False
+            for cache in caches:
+                start = time()
+                try:
+                    more = cache.maintain_step(self.budget) or more
+                except Exception:
+                    traceback.print_exc()
+                if cache.stats is not None:
+                    cache.stats.observe('maintain_step', time() - start)
+                    cache.stats.report()
+            del caches
+
+            sleep(0 if more else self.interval)
+
+
+default_maintainer = Maintainer()
+
+
+#####################
+# statistics
+#####################
+
+class CacheStats(object):
+    """
+        Statistics of a cache, enabled by the `stats` option of caches.
+        counters -> name -> number, e.g. rows_scanned, bytes_encoded
+        latencies -> name -> histogram of seconds, e.g. API names, lock_wait, maintain
+                     calls are counted into buckets by upper bounds in `bounds`.
+        gauges -> name -> callback returns the current value, e.g. records
+        Usage:
+            cache = SimpleCache(stats=True)
+            ...
+            print cache.stats.snapshot()
+    """
+
+    bounds = (1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0, float('inf'))
+
+    def __init__(self, callback=None, interval=60):
+        """
+            input:
+                callback -> called with snapshot() every `interval` seconds,
+                            e.g. to export to a metrics system.
+                            it's checked, and called, by report() in the thread of an API call,
+                            after the locks of the cache are released, so it may use the cache.
+        """
+        if callback is not None:
+            assert callable(callback)
+        self.callback = callback
+        self.interval = interval
+        self._next_report = time() + interval
+        self._reporting = local()   # set in the thread running callback
+        self._gauges = {}
+        self._lock = Lock()
+        self.reset()
+
+    def gauge(self, name, callback):
+        assert callable(callback)
+        self._gauges[name] = callback
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        """
+            count a latency of `name` into its histogram.
+        """
+        with self._lock:
+            hist = self._latencies.get(name)
+            if hist is None:
+                hist = self._latencies[name] = [0, 0.0, 0.0, [0] * len(self.bounds)]
+            hist[0] += 1
+            hist[1] += seconds
+            if seconds > hist[2]:
+                hist[2] = seconds
+            hist[3][bisect.bisect_left(self.bounds, seconds)] += 1
+
+    def report(self):
+        """
+            call callback with snapshot() if `interval` seconds passed since the last call.
+            caches call it with no lock held.
+        """
+        if self.callback is None or time() < self._next_report:
+            return
+        if getattr(self._reporting, 'active', False):
+            # the cache is used by callback
+            return
+        with self._lock:
+            # one thread reports
+            now = time()
+            if now < self._next_report:
+                return
+            self._next_report = now + self.interval
+        self._reporting.active = True
+        try:
+            self.callback(self.snapshot())
+        finally:
+            self._reporting.active = False
+
+    def snapshot(self):
+        """
+            output:
+                {
+                    'counters': {name: number},
+                    'latencies': {name: {'count', 'total', 'max', 'buckets'}},
+                    'gauges': {name: value},
+                    'seconds': seconds since created or reset,
+                }
+                buckets are counts of calls, in the order of `bounds`.
+        """
+        with self._lock:
+            latencies = dict(
+                (name, {'count': count, 'total': total, 'max': max_, 'buckets': list(buckets)})
+                for name, (count, total, max_, buckets) in self._latencies.iteritems()
+            )
+            snapshot = {
+                'counters': dict(self._counters),
+                'latencies': latencies,
+                'seconds': time() - self._since,
+            }
+        snapshot['gauges'] = dict((name, get()) for name, get in self._gauges.iteritems())
+        return snapshot
+
+    def reset(self):
+        """
+            clear counters and latencies, gauges are kept.
+            output:
+                snapshot() before reset.
+        """
+        snapshot = self.snapshot() if hasattr(self, '_since') else None
+        with self._lock:
+            self._counters = {}
+            self._latencies = {}    # name -> [count, total, max, buckets]
+            self._since = time()
+        return snapshot
+
+
+def _make_stats(stats):
+    if stats is True:
+        return CacheStats()
+    assert stats is None or stats is False or isinstance(stats, CacheStats)
+    return stats or None
+
+
+class _Index(object):
+    """
+        hash index of SimpleCache.
+        key -> sequence numbers of records which have the key.
+    """
+
+    def __init__(self, keyfunc):
+        assert callable(keyfunc)
+        self.keyfunc = keyfunc
+        self.clear()
+
+    def clear(self):
+        self.buckets = {}
+        self.keys = {}      # seq -> key
+
+    def add(self, seq, record):
+        key = self.keyfunc(record)
+        self.buckets.setdefault(key, set()).add(seq)
+        self.keys[seq] = key
+
+    def remove(self, seq):
+        key = self.keys.pop(seq)
+        bucket = self.buckets[key]
+        bucket.discard(seq)
+        if not bucket:
+            del self.buckets[key]
+
+    def get(self, key):
+        return self.buckets.get(key, ())
+
+
+class _Positions(object):
+    """
+        live slots of an append-only list with removed slots (a Fenwick tree),
+        so that the i-th live slot is found in O(log n), without compaction.
+        slots are 0-based.
+    """
+
+    def __init__(self, size=0):
+        # all `size` slots are live
+        tree = [0] + [1] * size
+        for i in xrange(1, size + 1):
+            parent = i + (i & -i)
+            if parent <= size:
+                tree[parent] += tree[i]
+        self.tree = tree
+        self.count = size
+
+    def _prefix(self, i):
+        # live slots in [0, i)
+        tree = self.tree
+        total = 0
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def append(self):
+        i = len(self.tree)
+        self.tree.append(self._prefix(i - 1) - self._prefix(i - (i & -i)) + 1)
+        self.count += 1
+
+    def remove(self, slot):
+        tree = self.tree
+        i = slot + 1
+        while i < len(tree):
+            tree[i] -= 1
+            i += i & -i
+        self.count -= 1
+
+    def find(self, k):
+        """
+            slot of the k-th (0-based) live slot, 0 <= k < count.
+        """
+        tree = self.tree
+        pos = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            nxt = pos + step
+            if nxt < len(tree) and tree[nxt] <= k:
+                pos = nxt
+                k -= tree[nxt]
+            step >>= 1
+        return pos
+
+
+#####################
+# eviction policies
+#   track tokens (hashable) of cached items,
+#   victim() pops the token which should be evicted.
+#####################
+
+class FIFOPolicy(object):
+    """
+        evict the earliest added item.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.order)
+
+    def clear(self):
+        self.order = OrderedDict()
+
+    def add(self, token):
+        self.order[token] = True
+
+    def touch(self, token):
+        pass
+
+    def discard(self, token):
+        self.order.pop(token, None)
+
+    def victim(self):
+        return self.order.popitem(last=False)[0]
+
+
+class LRUPolicy(FIFOPolicy):
+    """
+        evict the least recently used item.
+    """
+
+    def touch(self, token):
+        if self.order.pop(token, None):
+            self.order[token] = True
+
+
+class LFUPolicy(object):
+    """
+        evict the least frequently used item,
+        the earliest one among items with the same frequency.
+        frequencies of evicted items are remembered (as many as resident items),
+        so an item added again goes on from its frequency.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.freqs)
+
+    def clear(self):
+        self.freqs = {}         # token -> frequency
+        self.buckets = {}       # frequency -> tokens
+        self.min_freq = 0
+        self.history = OrderedDict()    # evicted token -> frequency
+
+    def _link(self, token, freq):
+        self.freqs[token] = freq
+        bucket = self.buckets.get(freq)
+        if bucket is None:
+            bucket = self.buckets[freq] = OrderedDict()
+        bucket[token] = True
+
+    def _unlink(self, token, freq):
+        bucket = self.buckets[freq]
+        del bucket[token]
+        if not bucket:
+            del self.buckets[freq]
+            if self.min_freq == freq:
+                self.min_freq = freq + 1
+
+    def add(self, token):
+        self.discard(token)
+        freq = self.history.pop(token, 0) + 1
+        self._link(token, freq)
+        if len(self.freqs) == 1 or freq < self.min_freq:
+            self.min_freq = freq
+
+    def touch(self, token):
+        freq = self.freqs.get(token)
+        if freq is not None:
+            self._unlink(token, freq)
+            self._link(token, freq + 1)
+
+    def discard(self, token):
+        freq = self.freqs.pop(token, None)
+        if freq is not None:
+            self._unlink(token, freq)
+
+    def victim(self):
+        if self.min_freq not in self.buckets:
+            # min_freq is lost after discard
+            self.min_freq = min(self.buckets)
+        token = self.buckets[self.min_freq].popitem(last=False)[0]
+        freq = self.freqs.pop(token)
+        if not self.buckets[freq]:
+            del self.buckets[freq]
+
+        self.history[token] = freq
+        while len(self.history) > max(len(self.freqs), 1):
+            self.history.popitem(last=False)
+        return token
+
+
+class ARCPolicy(object):
+    """
+        Adaptive Replacement Cache.
+        t1 -> items seen once, t2 -> items seen at least twice,
+        b1, b2 -> ghosts of items evicted from t1, t2.
+        `p`, the target size of t1, adapts on ghost hits.
+        ghosts are bounded by the number of resident items.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
+
+    def clear(self):
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.p = 0
+
+    def add(self, token):
+        self.discard(token)
+        size = len(self) + 1
+        if token in self.b1:
+            self.p = min(size, self.p + max(len(self.b2) // len(self.b1), 1))
+            del self.b1[token]
+            self.t2[token] = True
+        elif token in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) // len(self.b2), 1))
+            del self.b2[token]
+            self.t2[token] = True
+        else:
+            self.t1[token] = True
+
+    def touch(self, token):
+        if self.t1.pop(token, None) or self.t2.pop(token, None):
+            self.t2[token] = True
+
+    def discard(self, token):
+        self.t1.pop(token, None)
+        self.t2.pop(token, None)
+
+    def victim(self):
+        if self.t1 and (len(self.t1) > self.p or not self.t2):
+            token = self.t1.popitem(last=False)[0]
+            self.b1[token] = True
+        else:
+            token = self.t2.popitem(last=False)[0]
+            self.b2[token] = True
+
+        limit = max(len(self), 1)
+        while len(self.b1) > limit:
+            self.b1.popitem(last=False)
+        while len(self.b2) > limit:
+            self.b2.popitem(last=False)
+        return token
+
+
+eviction_policies = {
+    'fifo': FIFOPolicy,
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+    'arc': ARCPolicy,
+}
+
+
+#####################
+# declarative conditions
+#####################
+
+_missing = object()
+
+def _field_getter(field):
+    def get(rec):
+        if isinstance(rec, dict):
+            return rec.get(field, _missing)
+        return getattr(rec, field, _missing)
+    return get
+
+
+def _numeric_column(records, field, columns):
+    """
+        numpy array of `field` of all records,
+        None if any record is not a dict or has no numeric value of `field`.
+        arrays are cached in `columns`.
+    """
+    if field in columns:
+        return columns[field]
+
+    column = None
+    values = []
+    for rec in records:
+        if not isinstance(rec, dict):
+            break
+        value = rec.get(field, _missing)
+        if not isinstance(value, (int, long, float)):
+            break
+        values.append(value)
+    else:
+        column = numpy.array(values)
+        if column.dtype.kind not in 'biuf':
+            column = None
+
+    columns[field] = column
+    return column
+
+
+def sql_scalar(value):
+    """
+        value as it's bound to a sqlite parameter,
+        None if sqlite can not store and compare it the same as python:
+            unicode, str in UTF-8 (bound as unicode),
+            integers within 64 bits, floats except NaN.
+    """
+    if isinstance(value, unicode):
+        return value
+    if isinstance(value, str):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    if isinstance(value, (int, long)):
+        return value if -2 ** 63 <= value < 2 ** 63 else None
+    if isinstance(value, float):
+        # NaN is stored as NULL
+        return None if value != value else value
+    return None
+
+
+# stored in a declared column for a present value that is not a sql scalar (None included),
+# so that NULL only means a missing field. blobs sort after numbers and strings.
+_odd_column = sqlite3.Binary('')
+
+
+def quote_column(name):
+    return '"%s"' % name.replace('"', '""')
+
+
+def _select(items, mask):
+    """
+        items whose mask is true.
+    """
+    if numpy is not None and isinstance(mask, numpy.ndarray):
+        return [items[i] for i in numpy.flatnonzero(mask)]
+    return [item for item, matched in izip(items, mask) if matched]
+
+
+def _contains(value, values):
+    """
+        value in values, which may be a frozenset, while value may be unhashable.
+    """
+    try:
+        return value in values
+    except TypeError:
+        return any(value == v for v in values)
+
+
+class Q(object):
+    """
+        A declarative condition on dict records (attributes for other objects).
+        Q is callable, so it can be passed wherever a condition callback is expected.
+
+        lookups:
+            field=value, field__eq=value
+            field__ne, field__gt, field__ge, field__lt, field__le
+            field__in=values
+        records without the field never match a lookup.
+        combine with &, |, ~
+
+        Usage:
+            cond = Q(sid='a1', level__ge=3) | ~Q(kind__in=('ping', 'pong'))
+            cache.filter(cond)
+
+        The condition is compiled once.
+        mask() evaluates it over many records in one pass,
+        numeric lookups run as numpy array operations when numpy is available.
+        to_sql() translates lookups on declared columns into a SQL expression.
+    """
+
+    sql_operators = {
+        'eq': '=',
+        'ne': '!=',
+        'gt': '>',
+        'ge': '>=',
+        'lt': '<',
+        'le': '<=',
+    }
+
+    operators = {
+        'eq': operator.eq,
+        'ne': operator.ne,
+        'gt': operator.gt,
+        'ge': operator.ge,
+        'lt': operator.lt,
+        'le': operator.le,
+        'in': _contains,
+    }
+
+    # below this number of records, mask() does not bother numpy.
+    vectorize_min = 256
+
+    def __init__(self, **lookups):
+        self.connector = 'and'
+        self.negated = False
+        self.children = []      # leaves (field, op, value) or Q
+        self._test = None
+
+        for lookup, value in sorted(lookups.iteritems()):
+            field, _, op = lookup.rpartition('__')
+            if not field or op not in self.operators:
+                field, op = lookup, 'eq'
+            if op == 'in':
+                try:
+                    value = frozenset(value)
+                except TypeError:
+                    value = tuple(value)
+            self.children.append((field, op, value))
+
+    def _combine(self, other, connector):
+        assert isinstance(other, Q)
+        q = Q()
+        q.connector = connector
+        for child in (self, other):
+            if child.connector == connector and not child.negated:
+                q.children.extend(child.children)
+            else:
+                q.children.append(child)
+        return q
+
+    def __and__(self, other):
+        return self._combine(other, 'and')
+
+    def __or__(self, other):
+        return self._combine(other, 'or')
+
+    def __invert__(self):
+        q = Q()
+        q.children.append(self)
+        q.negated = True
+        return q
+
+    def __repr__(self):
+        children = ', '.join(
+            repr(child) if isinstance(child, Q) else '%s__%s=%r' % child
+            for child in self.children
+        )
+        return '%sQ(%s: %s)' % ('~' if self.negated else '', self.connector, children)
+
+    ###################
+    # evaluation
+    ###################
+
+    @staticmethod
+    def _compile_leaf(field, op, value):
+        get = _field_getter(field)
+        compare = Q.operators[op]
+        def test(rec):
+            v = get(rec)
+            return v is not _missing and compare(v, value)
+        return test
+
+    def _compile(self):
+        tests = [
+            child._compile() if isinstance(child, Q) else self._compile_leaf(*child)
+            for child in self.children
+        ]
+
+        if len(tests) == 1:
+            test = tests[0]
+        elif self.connector == 'and':
+            def test(rec):
+                for t in tests:
+                    if not t(rec):
+                        return False
+                return True
+        else:
+            def test(rec):
+                for t in tests:
+                    if t(rec):
+                        return True
+                return False
+
+        if self.negated:
+            positive = test
+            test = lambda rec: not positive(rec)
+        return test
+
+    def __call__(self, rec):
+        if self._test is None:
+            self._test = self._compile()
+        return self._test(rec)
+
+    def _leaf_mask(self, records, columns, field, op, value):
+        column = _numeric_column(records, field, columns)
+        if column is not None:
+            if op == 'in':
+                if all(isinstance(v, (int, long, float)) for v in value):
+                    return numpy.in1d(column, list(value))
+            elif isinstance(value, (int, long, float)):
+                return self.operators[op](column, value)
+
+        test = self._compile_leaf(field, op, value)
+        return numpy.fromiter((test(rec) for rec in records), dtype=bool, count=len(records))
+
+    def _mask(self, records, columns):
+        masks = [
+            child._mask(records, columns) if isinstance(child, Q)
+            else self._leaf_mask(records, columns, *child)
+            for child in self.children
+        ]
+
+        if not masks:
+            mask = numpy.ones(len(records), dtype=bool)
+        elif self.connector == 'and':
+            mask = numpy.logical_and.reduce(masks)
+        else:
+            mask = numpy.logical_or.reduce(masks)
+
+        if self.negated:
+            mask = ~mask
+        return mask
+
+    ###################
+    # sql
+    ###################
+
+    def _fields(self):
+        """
+            generator of fields looked up by the condition.
+        """
+        for child in self.children:
+            if isinstance(child, Q):
+                for field in child._fields():
+                    yield field
+            else:
+                yield child[0]
+
+    @staticmethod
+    def _leaf_sql(columns, field, op, value):
+        if field not in columns:
+            return None, ()
+
+        values = [sql_scalar(v) for v in (value if op == 'in' else (value, ))]
+        if None in values:
+            return None, ()
+
+        column = quote_column(field)
+        if op == 'in':
+            if not values:
+                return '0', ()
+            return '%s IN (%s)' % (column, ', '.join('?' * len(values))), tuple(values)
+        return '%s %s ?' % (column, Q.sql_operators[op]), tuple(values)
+
+    def to_sql(self, columns):
+        """
+            split the condition into a SQL expression on `columns`
+            and a residual condition for the rest.
+            the condition matches a record iff both of them do.
+            input:
+                columns -> names of columns which hold scalar values of the fields,
+                           NULL if a record has no such field.
+                           a column holding other values must not be given,
+                           lookups on it are left to the residual.
+            output:
+                (sql, params, residual)
+                sql -> SQL expression, None if nothing can be done by SQL
+                params -> parameters of sql
+                residual -> Q, None if everything is done by SQL
+        """
+        parts = []
+        params = []
+        residual = []
+        for child in self.children:
+            if isinstance(child, Q):
+                sql, child_params, rest = child.to_sql(columns)
+            else:
+                sql, child_params = self._leaf_sql(columns, *child)
+                rest = child if sql is None else None
+            if sql is not None:
+                parts.append(sql)
+                params.extend(child_params)
+            if rest is not None:
+                residual.append(rest)
+
+        if self.connector == 'and' and not self.negated:
+            # conjunction can be split
+            sql = ' AND '.join('(%s)' % part for part in parts) or None
+            rest = None
+            if len(residual) == 1 and isinstance(residual[0], Q):
+                rest = residual[0]
+            elif residual:
+                rest = Q()
+                rest.children = residual
+            return sql, params, rest
+
+        if residual:
+            return None, [], self
+
+        connector = ' AND ' if self.connector == 'and' else ' OR '
+        sql = connector.join('(%s)' % part for part in parts) or '1'
+        if self.negated:
+            # NULL (missing field) never matches a lookup, so its negation matches.
+            sql = 'NOT COALESCE(%s, 0)' % sql
+        return sql, params, None
+
+    def mask(self, records):
+        """
+            evaluate the condition on a sequence of records.
+            return a list of bool, or a numpy bool array.
+            input:
+                records -> a sequence,
+                           numeric columns are cached on its `columns` dict if it has one.
+        """
+        if numpy is None or len(records) < self.vectorize_min:
+            test = self.__call__
+            return [test(rec) for rec in records]
+
+        columns = getattr(records, 'columns', None)
+        if columns is None:
+            columns = {}
+        return self._mask(records, columns)
+
+
+class CacheSnapshot(tuple):
+    """
+        An immutable view of SimpleCache records.
+        version -> version of the cache when the snapshot is taken,
+                   the version changes on every modification.
+        columns -> numeric columns built by Q.mask, cached with the snapshot,
+                   so records should not be changed in place.
+    """
+
+    def __new__(cls, records, version, seqs=()):
+        snapshot = tuple.__new__(cls, records)
+        snapshot.version = version
+        snapshot.columns = {}
+        snapshot._seqs = seqs
+        return snapshot
 
 
 class SimpleCache(object):
     """
         A simple in-memory store.
         APIs: 
-            add, filter, exclude
-            APIs are thread-safe.
+            add, filter, exclude, get_by, exclude_by, snapshot
+            APIs are thread-safe,
+            with concurrency='rw', readers (filter, get_by, iteration ...)
+            run in parallel and only writers are exclusive.
+        counters:
+            hits, misses -> get_by found records or not
+            evictions -> records evicted for max_items/max_bytes
     """
 
-    def __init__(self, outdate_cond=None, timing=None):
+    def __init__(self, outdate_cond=None, timing=None, indexes=None, ttl=None,
+                 max_items=None, max_bytes=None, policy='lru', sizeof=sys.getsizeof,
+                 concurrency='lock', background=None, on_evict=None, stats=None,
+                 policy_key=None):
         """
             input:
                 outdate_cond
@@ -37,31 +886,261 @@ class SimpleCache(object):
                     a decimal
                     maintaining process will proceed at at least every `timing` secods.
                     if None, maintaining process before every action.
+                indexes:
+                    a dict, index name -> key callback
+                    records are hashed by the key returned from the callback,
+                    get_by and exclude_by look up records by the index
+                    without scanning the whole cache.
+                ttl:
+                    a decimal, default time-to-live (in seconds) of added records.
+                    records are kept in a heap ordered by expiry time,
+                    so maintenance only touches expired records.
+                    if None, records do not expire (unless `ttl` is given to add).
+                max_items:
+                    an integer, max number of records.
+                max_bytes:
+                    an integer, max total size of records, measured by `sizeof`.
+                policy:
+                    eviction policy used when max_items/max_bytes is exceeded,
+                    a name in eviction_policies ('lru', 'lfu', 'fifo', 'arc'),
+                    or a policy instance.
+                    records returned by get_by are counted as accessed.
+                policy_key:
+                    an index name, whose keys identify records for the eviction policy,
+                    so that frequencies (lfu) and ghosts (arc) of an evicted key are remembered
+                    when a record of it is added again, and an update keeps them (see add).
+                    records of a key are evicted together.
+                    without it, each added record is a new item, so 'arc' needs it.
+                sizeof:
+                    a callback, returns size of a record.
+                    sys.getsizeof is shallow, pass a deeper one for nested records.
+                on_evict:
+                    a callback, called with each record evicted for max_items/max_bytes.
+                    it's called under the writer lock, so it should not call the cache.
+                stats:
+                    True or a CacheStats, measure APIs, lock wait and maintenance,
+                    count rows scanned and returned by filter and exclude.
+                    gauges: records, bytes, hits, misses, evictions.
+                concurrency:
+                    'lock' -> one exclusive lock for all APIs.
+                    'rw' -> a reader-writer lock,
+                            maintenance is done under the writer side,
+                            so with timing=None every API is exclusive.
+                background:
+                    True or a Maintainer,
+                    maintain in a background thread (default_maintainer if True),
+                    instead of before API calls.
+                    expired and outdated records may be seen until they are maintained.
         """
-        self.cache = []
+        self._records = {}      # seq -> record
+        self._order = []        # seqs in insertion order, may contain removed seqs
+        self._positions = _Positions()  # live slots of _order, for positional access
+        self._seq = 0
+        self._version = 0
+        self._snapshot = None   # CacheSnapshot of current version, rebuilt after any change
+        self._expiry = []       # heap of (expire time, seq)
+
+        self._indexes = {}
+        for name, keyfunc in (indexes or {}).iteritems():
+            self._indexes[name] = _Index(keyfunc)
+
         self.outdate_cond = outdate_cond
         if self.outdate_cond is not None:
             assert callable(self.outdate_cond)
 
         self.timing = timing
+        self.ttl = ttl
+
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._sizes = {}        # seq -> size, only when max_bytes
+        self.sizeof = sizeof
+        if self.max_bytes is not None:
+            assert callable(self.sizeof)
+
+        self._policy = None
+        self._policy_index = None
+        if policy_key is not None:
+            assert policy_key in self._indexes, 'unknown index: %s' % policy_key
+            self._policy_index = self._indexes[policy_key]
+        if self.max_items is not None or self.max_bytes is not None:
+            if isinstance(policy, basestring):
+                assert policy != 'arc' or policy_key is not None, "'arc' needs policy_key"
+                policy = eviction_policies[policy]()
+            self._policy = policy
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.on_evict = on_evict
+        if self.on_evict is not None:
+            assert callable(self.on_evict)
+
+        if concurrency == 'rw':
+            lock = RWLock()
+            self._read_lock, self._write_lock = lock.reader, lock.writer
+        else:
+            assert concurrency == 'lock', 'unknown concurrency: %s' % concurrency
+            self._read_lock = self._write_lock = Lock()
+        # guards policy and counters, which are updated by readers
+        self._mutex = Lock()
+
+        self.stats = _make_stats(stats)
+        if self.stats is not None:
+            self.stats.gauge('records', lambda: len(self._records))
+            self.stats.gauge('bytes', lambda: self.bytes)
+            self.stats.gauge('hits', lambda: self.hits)
+            self.stats.gauge('misses', lambda: self.misses)
+            self.stats.gauge('evictions', lambda: self.evictions)
+
+        self.slice_size = 256       # records per slice of maintain_step
+        self._scan_from = None      # seq where an incremental outdate scan resumes
+        self._maintainer = None
+        if background:
+            self._maintainer = default_maintainer if background is True else background
+            self._maintainer.register(self)
+
+
+    @property
+    def cache(self):
+        """
+            CacheSnapshot of cached records, in insertion order.
+            it is shared by readers until the cache is modified.
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            records = self._records
+            seqs = [seq for seq in self._order if seq in records]
+            snapshot = self._snapshot = CacheSnapshot(
+                [records[seq] for seq in seqs],
+                self._version,
+                seqs
+            )
+        return snapshot
+
+    @property
+    def version(self):
+        return self._version
+
+    def _modified(self):
+        self._version += 1
+        self._snapshot = None
+
+
+    def _token(self, seq):
+        """
+            item of a record in the eviction policy.
+        """
+        if self._policy_index is None:
+            return seq
+        return self._policy_index.keys[seq]
+
+    def _insert(self, record, ttl=None):
+        self._seq += 1
+        seq = self._seq
+        for index in self._indexes.itervalues():
+            index.add(seq, record)
+        self._records[seq] = record
+        self._order.append(seq)
+        self._positions.append()
+        if self._policy is not None:
+            token = self._token(seq)
+            if self._policy_index is not None and len(self._policy_index.get(token)) > 1:
+                # another record of the key is cached
+                self._policy.touch(token)
+            else:
+                self._policy.add(token)
+        if self.max_bytes is not None:
+            size = self._sizes[seq] = self.sizeof(record)
+            self.bytes += size
+        if ttl is not None:
+            heapq.heappush(self._expiry, (time() + ttl, seq))
+        self._modified()
+        return seq
+
+
+    def _remove(self, seqs):
+        """
+            remove records by sequence numbers,
+            return the removed records.
+        """
+        records = self._records
+        order = self._order
+        removed = []
+        for seq in seqs:
+            if seq not in records:
+                continue
+            # seqs in _order are ascending
+            self._positions.remove(bisect.bisect_left(order, seq))
+            if self._policy is not None:
+                token = self._token(seq)
+            for index in self._indexes.itervalues():
+                index.remove(seq)
+            if self._policy is not None:
+                if self._policy_index is None or not self._policy_index.get(token):
+                    self._policy.discard(token)
+            if self.max_bytes is not None:
+                self.bytes -= self._sizes.pop(seq)
+            removed.append(records.pop(seq))
+
+        if removed:
+            self._modified()
+            # drop removed seqs once they dominate the order list and expiry heap
+            if len(self._order) > 2 * len(records) + 64:
+                self._order = [seq for seq in self._order if seq in records]
+                self._positions = _Positions(len(self._order))
+            if len(self._expiry) > 2 * len(records) + 64:
+                self._expiry = [item for item in self._expiry if item[1] in records]
+                heapq.heapify(self._expiry)
+
+        return removed
+
+
+    def _evict(self):
+        """
+            evict records until max_items and max_bytes are satisfied.
+        """
+        records = self._records
+        while (self.max_items is not None and len(records) > self.max_items) or \
+              (self.max_bytes is not None and self.bytes > self.max_bytes):
+            token = self._policy.victim()
+            if self._policy_index is None:
+                removed = self._remove([token])
+            else:
+                removed = self._remove(sorted(self._policy_index.get(token)))
+            self.evictions += len(removed)
+            if self.on_evict is not None:
+                for record in removed:
+                    self.on_evict(record)
 
 
     def _exclude(self, exclude_cond=None):
-        if exclude_cond:
+        if isinstance(exclude_cond, Q):
+            snapshot = self.cache
+            excluded = self._remove(_select(snapshot._seqs, exclude_cond.mask(snapshot)))
+        elif exclude_cond:
             assert callable(exclude_cond)
 
-            excluded = filter(
-                lambda rec: exclude_cond(rec),
-                self.cache
-            )
-            self.cache = filter(
-                lambda rec: not exclude_cond(rec),
-                self.cache
-            )
+            records = self._records
+            excluded = self._remove([
+                seq for seq in self._order
+                if seq in records and exclude_cond(records[seq])
+            ])
         else:
             # remove all
-            excluded = self.cache
-            self.cache = []
+            excluded = list(self.cache)
+            self._records = {}
+            self._order = []
+            self._positions = _Positions()
+            self._expiry = []
+            self._modified()
+            self._sizes = {}
+            self.bytes = 0
+            if self._policy is not None:
+                self._policy.clear()
+            for index in self._indexes.itervalues():
+                index.clear()
 
         return excluded
 
@@ -81,11 +1160,38 @@ class SimpleCache(object):
         self._maintain_deadline = value
 
 
+    def _expire(self):
+        """
+            remove records whose ttl is over.
+        """
+        expiry = self._expiry
+        now = time()
+        seqs = []
+        while expiry and expiry[0][0] <= now:
+            seqs.append(heapq.heappop(expiry)[1])
+        if seqs:
+            seqs.sort()
+            self._remove(seqs)
+
+
+    def _maintenance_due(self):
+        if self._maintainer is not None:
+            return False
+        expiry = self._expiry
+        if expiry and expiry[0][0] <= time():
+            return True
+        if not self.outdate_cond:
+            return False
+        return self.timing is None or time() >= self.maintain_deadline
+
+
     def maintain(self):
         """
-            remove outdated records,
-            according to the returned value of outdate_cond
+            remove expired records,
+            and outdated records according to the returned value of outdate_cond
         """
+        self._expire()
+
         if not self.outdate_cond:
             # no outdate condition, do not maintain.
             return
@@ -97,11 +1203,125 @@ class SimpleCache(object):
                 self._exclude(self.outdate_cond)
                 self.maintain_deadline = time() + self.timing
 
-    # decorator
-    def _maintained(method):
+    def _maintain_slice(self, size):
+        """
+            expire or check at most `size` records.
+            return True if there's more to do.
+        """
+        expiry = self._expiry
+        now = time()
+        seqs = []
+        while expiry and expiry[0][0] <= now and len(seqs) < size:
+            seqs.append(heapq.heappop(expiry)[1])
+        if seqs:
+            seqs.sort()
+            self._remove(seqs)
+            return True
+
+        if not self.outdate_cond:
+            return False
+
+        if self._scan_from is None:
+            if self.timing is not None and now < self.maintain_deadline:
+                return False
+            self._scan_from = 0
+
+        # seqs in _order are ascending
+        order = self._order
+        pos = bisect.bisect_right(order, self._scan_from)
+        chunk = order[pos:pos + size]
+        records = self._records
+        self._remove([
+            seq for seq in chunk
+            if seq in records and self.outdate_cond(records[seq])
+        ])
+
+        if len(chunk) < size:
+            # a pass is done
+            self._scan_from = None
+            if self.timing is not None:
+                self.maintain_deadline = time() + self.timing
+            return False
+
+        self._scan_from = chunk[-1]
+        return True
+
+
+    def maintain_step(self, budget=0.005):
+        """
+            maintain incrementally, used by Maintainer.
+            the writer lock is held for one slice at a time,
+            and released between slices.
+            input:
+                budget -> seconds to spend at most (roughly)
+            output:
+                bool -> if there's more to do.
+        """
+        deadline = time() + budget
+        while True:
+            with self._write_lock:
+                more = self._maintain_slice(self.slice_size)
+            if not more or time() >= deadline:
+                return more
+
+    def _measured(self, name, lock, maintain, method=None, args=(), kwargs={}):
+        """
+            _reading and _writing with stats:
+            acquire lock, maintain if `maintain`, then call method (if any), all measured.
+        """
+        stats = self.stats
+        start = time()
+        try:
+            with lock:
+                locked = time()
+                stats.observe('lock_wait', locked - start)
+                if maintain:
+                    self.maintain()
+                    stats.observe('maintain', time() - locked)
+                if method is None:
+                    return
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    stats.observe(name, time() - start)
+        finally:
+            stats.report()
+
+    # decorators
+    def _writing(method):
+        name = method.__name__
         def new_method(self, *args, **kwargs):
-            self.maintain()
-            return method(self, *args, **kwargs)
+            if self.stats is not None:
+                return self._measured(name, self._write_lock, self._maintainer is None,
+                                      method, args, kwargs)
+            with self._write_lock:
+                if self._maintainer is None:
+                    self.maintain()
+                return method(self, *args, **kwargs)
+        return new_method
+
+    def _reading(method):
+        name = method.__name__
+        def new_method(self, *args, **kwargs):
+            if self._read_lock is self._write_lock:
+                if self.stats is not None:
+                    return self._measured(name, self._write_lock, self._maintainer is None,
+                                          method, args, kwargs)
+                with self._write_lock:
+                    if self._maintainer is None:
+                        self.maintain()
+                    return method(self, *args, **kwargs)
+
+            if self._maintenance_due():
+                if self.stats is not None:
+                    self._measured(name, self._write_lock, True)
+                else:
+                    with self._write_lock:
+                        self.maintain()
+            if self.stats is not None:
+                return self._measured(name, self._read_lock, False, method, args, kwargs)
+            with self._read_lock:
+                return method(self, *args, **kwargs)
         return new_method
 
 
@@ -109,275 +1329,2197 @@ class SimpleCache(object):
     # APIs
     ##################
 
-    # @_threadsafe
-    @mthread_safe()
-    @_maintained
+    @_reading
     def __iter__(self):
+        """
+            iterate the snapshot, changes during the iteration are not seen.
+        """
         return iter(self.cache)
 
-    # @_threadsafe
-    @mthread_safe()
-    @_maintained
+    def _record_at(self, i):
+        return self._records[self._order[self._positions.find(i)]]
+
+    @_reading
     def __getitem__(self, given):
         """
             input:
-                given -> slice or index
+                given -> slice or index
+            O(log n) per record, no copy of the cache is made.
+        """
+        count = self._positions.count
+        if isinstance(given, slice):
+            return [self._record_at(i) for i in xrange(*given.indices(count))]
+
+        if given < 0:
+            given += count
+        if not 0 <= given < count:
+            raise IndexError('cache index out of range')
+        return self._record_at(given)
+
+    @_reading
+    def snapshot(self):
+        """
+            immutable view (CacheSnapshot) of cached records,
+            consistent even if the cache is modified afterwards.
+            no copy is made unless the cache changed since the last snapshot.
+        """
+        return self.cache
+
+    @_writing
+    def add(self, *records, **options):
+        """
+            append records to cache.
+            options:
+                ttl -> time-to-live of these records, default: self.ttl
+                replace -> an index name, cached records with the same key of the index
+                           are removed after each record is added,
+                           so that an update is an access of its key for policy_key.
+        """
+        ttl = options.get('ttl', self.ttl)
+        replace = options.get('replace')
+        if replace is not None:
+            index = self._indexes[replace]
+        for record in records:
+            if replace is None:
+                self._insert(record, ttl)
+            else:
+                old = sorted(index.get(index.keyfunc(record)))
+                self._insert(record, ttl)
+                self._remove(old)
+        if self._policy is not None:
+            self._evict()
+
+    @_reading
+    def filter(self, filter_cond=None):
+        """
+            filter cached message with callback filter_cond,
+            or a Q condition.
+        """
+
+        if isinstance(filter_cond, Q):
+            filtered = _select(self.cache, filter_cond.mask(self.cache))
+        elif filter_cond:
+            assert callable(filter_cond)
+            filtered = [rec for rec in self.cache if filter_cond(rec)]
+        else:
+            filtered = list(self.cache)
+
+        if self.stats is not None:
+            self.stats.incr('rows_scanned', len(self.cache))
+            self.stats.incr('rows_returned', len(filtered))
+        return filtered
+
+    @_writing
+    def exclude(self, exclude_cond=None):
+        """
+            exclude cached data according to exclude_cond
+        """
+        if self.stats is not None:
+            self.stats.incr('rows_scanned', len(self._records))
+        excluded = self._exclude(exclude_cond)
+        if self.stats is not None:
+            self.stats.incr('rows_returned', len(excluded))
+        return excluded
+
+    @_reading
+    def get_by(self, index, key):
+        """
+            records whose key of `index` equals to `key`, in insertion order.
+            input:
+                index -> index name, declared in `indexes`
+                key -> the key
+        """
+        seqs = sorted(self._indexes[index].get(key))
+        with self._mutex:
+            if seqs:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+            if self._policy is not None:
+                for token in OrderedDict.fromkeys(self._token(seq) for seq in seqs):
+                    self._policy.touch(token)
+
+        records = self._records
+        return [records[seq] for seq in seqs]
+
+    @_writing
+    def exclude_by(self, index, key):
+        """
+            exclude records whose key of `index` equals to `key`.
+            return the excluded records, in insertion order.
+        """
+        return self._remove(sorted(self._indexes[index].get(key)))
+
+    del _reading, _writing
+
+
+try:
+    import cPickle as pickle
+except ImportError, e:
+    warnings.warn('no cPickle module.')
+    import pickle
+
+
+import marshal
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+#####################
+# codecs
+#   serialize values of SqliteStore,
+#   the id of codec (and compressor) is stored with each row.
+#####################
+
+class Codec(object):
+    """
+        input:
+            codec_id -> integer in [1, 255], stored in database, never change it.
+            name -> name to refer the codec
+            dumps -> python value -> str
+            loads -> str -> python value
+        a compressor is a codec from str to str.
+    """
+    def __init__(self, codec_id, name, dumps, loads):
+        assert 0 < codec_id < 256
+        self.id = codec_id
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+
+codecs = {}         # id or name -> Codec
+compressors = {}    # id or name -> Codec
+
+def register_codec(codec):
+    codecs[codec.id] = codecs[codec.name] = codec
+
+def register_compressor(codec):
+    compressors[codec.id] = compressors[codec.name] = codec
+
+
+register_codec(Codec(1, 'pickle', lambda v: pickle.dumps(v, pickle.HIGHEST_PROTOCOL), pickle.loads))
+register_codec(Codec(2, 'marshal', marshal.dumps, marshal.loads))
+register_codec(Codec(3, 'json', lambda v: json.dumps(v, separators=(',', ':')), json.loads))
+if msgpack is not None:
+    register_codec(Codec(4, 'msgpack',
+                         lambda v: msgpack.packb(v, use_bin_type=True),
+                         lambda raw: msgpack.unpackb(raw, raw=False)))
+
+register_compressor(Codec(1, 'zlib', zlib.compress, zlib.decompress))
+if lz4 is not None:
+    register_compressor(Codec(2, 'lz4', lz4.frame.compress, lz4.frame.decompress))
+
+
+def encode_value(value, codec, compressor=None, threshold=1024):
+    """
+        output:
+            (raw, codec id),
+            codec id holds the compressor id in its second byte.
+    """
+    raw = codec.dumps(value)
+    codec_id = codec.id
+    if compressor is not None and len(raw) >= threshold:
+        raw = compressor.dumps(raw)
+        codec_id |= compressor.id << 8
+    return raw, codec_id
+
+
+def decode_value(raw, codec_id):
+    compressor_id = codec_id >> 8
+    if compressor_id:
+        raw = compressors[compressor_id].loads(raw)
+    return codecs[codec_id & 0xff].loads(raw)
+
+
+class SqliteStoreValue(object):
+    def __init__(self, value):
+        self.value = value
+
+    @staticmethod
+    def dumps(store_v):
+        assert isinstance(store_v, SqliteStoreValue)
+        return pickle.dumps(store_v.value)
+
+    @staticmethod
+    def loads(raw):
+        return SqliteStoreValue(pickle.loads(raw))
+
+
+class ConnectionPoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+        A bounded pool of sqlite3 connections.
+        connections are created on demand by `connect`, up to max_connections,
+        and reused until the pool is closed.
+        connections opened before a fork are left to the parent process,
+        a child process opens its own.
+        Usage:
+            pool = ConnectionPool(lambda: sqlite3.connect(path, check_same_thread=False))
+            with pool.connection() as db:
+                db.execute('SELECT 1')
+    """
+
+    def __init__(self, connect, max_connections=4, timeout=None):
+        """
+            input:
+                connect -> callable returns a new connection,
+                           which must be usable from any thread.
+                max_connections -> max number of open connections.
+                timeout -> seconds to wait for a connection,
+                           ConnectionPoolTimeout is raised after that.
+                           if None, wait forever.
+        """
+        assert callable(connect)
+        assert max_connections >= 1
+        self._connect = connect
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+        self._cond = Condition(Lock())
+        self._idle = []
+        self._count = 0     # open connections, idle or checked out
+        self._pid = os.getpid()
+        self._fork_lock = Lock()
+        self.closed = False
+
+    def _forked(self):
+        """
+            a sqlite connection must not be used across fork,
+            and the lock may have been held by a thread of the parent.
+        """
+        with self._fork_lock:
+            if self._pid != os.getpid():
+                self._cond = Condition(Lock())
+                self._idle = []
+                self._count = 0
+                self._pid = os.getpid()
+
+    def checkout(self, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+        if self._pid != os.getpid():
+            self._forked()
+        with self._cond:
+            while True:
+                if self.closed:
+                    raise sqlite3.ProgrammingError('connection pool is closed')
+                if self._idle:
+                    return self._idle.pop()
+                if self._count < self.max_connections:
+                    self._count += 1
+                    break
+
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        raise ConnectionPoolTimeout('no connection available in %s seconds' % timeout)
+                    self._cond.wait(remaining)
+
+        try:
+            return self._connect()
+        except:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+
+    def checkin(self, db):
+        if self._pid != os.getpid():
+            # checked out before fork
+            return
+
+        try:
+            # never hand over an open transaction
+            db.rollback()
+            broken = False
+        except sqlite3.Error:
+            broken = True
+
+        with self._cond:
+            if self.closed or broken:
+                self._count -= 1
+                db.close()
+            else:
+                self._idle.append(db)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        db = self.checkout(self.timeout)
+        try:
+            yield db
+        finally:
+            self.checkin(db)
+
+    def close(self):
+        """
+            close idle connections,
+            checked out connections are closed when checked in.
+        """
+        with self._cond:
+            self.closed = True
+            for db in self._idle:
+                db.close()
+            self._count -= len(self._idle)
+            self._idle = []
+            self._cond.notify_all()
+
+
+class SqliteStore(object):
+
+    tab_name = 'litestore'
+
+    # statements are formatted once per store,
+    # and prepared once per connection by sqlite3's statement cache.
+    sql_templates = {
+        'create': '''
+            CREATE TABLE IF NOT EXISTS %(tab)s(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                value BLOB,
+                codec INTEGER
+            )
+        ''',
+        'cols': 'SELECT * FROM %(tab)s LIMIT 1',
+        'insert': 'INSERT INTO %(tab)s(value, codec, expires_at%(cols)s) VALUES(?, ?, ?%(col_params)s)',
+        'delete': 'DELETE FROM %(tab)s',
+        'scan': 'SELECT id, value, codec FROM %(tab)s WHERE id > ? ORDER BY id LIMIT ?',
+        'scan_where': 'SELECT id, value, codec FROM %(tab)s',
+        'delete_id': 'DELETE FROM %(tab)s WHERE id = ?',
+        'update_value': 'UPDATE %(tab)s SET value = ?, codec = ? WHERE id = ?',
+        # key-value
+        'put': 'INSERT OR REPLACE INTO %(tab)s(key, value, codec, expires_at%(cols)s) VALUES(?, ?, ?, ?%(col_params)s)',
+        'get': 'SELECT key, value, codec FROM %(tab)s WHERE key = ?',
+        'get_many': 'SELECT key, value, codec FROM %(tab)s WHERE key IN ',
+        'contains': 'SELECT 1 FROM %(tab)s WHERE key = ? LIMIT 1',
+        'delete_key': 'DELETE FROM %(tab)s WHERE key = ?',
+        # ttl
+        'expire': 'DELETE FROM %(tab)s WHERE expires_at <= ?',
+        'expire_limit': '''
+            DELETE FROM %(tab)s WHERE id IN (
+                SELECT id FROM %(tab)s WHERE expires_at <= ? LIMIT ?
+            )
+        ''',
+        'next_expiry': 'SELECT min(expires_at) FROM %(tab)s',
+    }
+
+    # max number of keys in one `IN (...)`
+    keys_per_query = 500
+
+    def __init__(self, path=':memory:', outdate_cond=None, timing=None, value_type=SqliteStoreValue, converter=None, adapter=None,
+                 background=None, pragmas=None, max_connections=4, cached_statements=100,
+                 columns=None, codec=None, compress=None, compress_threshold=1024,
+                 write_behind=False, batch_size=1000, flush_interval=1.0, max_pending=10000,
+                 ttl=None, stats=None):
+        """
+            input:
+                path -> database file, or ':memory:'
+                outdate_cond, timing -> see SimpleCache
+                value_type -> class of stored values, with staticmethod loads and dumps
+                converter, adapter -> override value_type.loads and value_type.dumps
+                codec -> name of a registered codec ('pickle', 'marshal', 'json', 'msgpack'),
+                         which serializes values into BLOB.
+                         if None, 'pickle' for plain values (default value_type,
+                         no converter and adapter), else value_type's loads and dumps.
+                         each row records its codec, so rows written by other codecs
+                         are still readable, see reencode().
+                compress -> name of a registered compressor ('zlib', 'lz4'),
+                            values larger than compress_threshold bytes are compressed.
+                write_behind -> if True, add() only buffers values,
+                                a flusher thread writes them in one transaction
+                                when batch_size values are buffered,
+                                or the oldest one has waited flush_interval seconds.
+                                add() blocks while max_pending values are buffered.
+                                other APIs and flush() write the buffer first.
+                ttl -> default time-to-live (in seconds) of added values,
+                       add/put accept `ttl` too. expiry time is an indexed column,
+                       so expired rows are deleted without reading any value.
+                stats -> True or a CacheStats, measure APIs, lock wait and maintenance,
+                         each batch of iter_filter and iter_exclude is measured as a call,
+                         count rows scanned (read from database) and returned,
+                         bytes encoded and decoded. gauges: pending.
+                background -> see SimpleCache
+                pragmas -> dict, pragmas executed on every new connection, e.g.
+                           {'journal_mode': 'WAL', 'synchronous': 'NORMAL',
+                            'cache_size': -16000, 'mmap_size': 268435456}
+                max_connections -> size of the connection pool,
+                                   always 1 for ':memory:', which is private to a connection.
+                                   reads (filter, get ...) share a reader-writer lock,
+                                   so up to max_connections of them run in parallel.
+                cached_statements -> size of the prepared statement cache of each connection
+                columns -> names of fields (keys of dict values, or attributes),
+                           which are extracted at `add` into indexed columns,
+                           so that Q conditions on them are done by SQL.
+                           values of these fields should be numbers or strings,
+                           while a column holds other values (None included),
+                           lookups on it are checked on decoded values.
+                           rows added before a column is declared have NULL in it.
+        """
+        self.vtype= value_type
+        self.dbpath = path
+        self.vtype_name = value_type.__name__
+
+        # ---- value_type.loads and value_type.dumps must be staticmethod ----
+        # be careful with pickle.
+        self._converter = converter or getattr(value_type, 'loads', None) or pickle.loads
+        self._adapter = adapter or getattr(value_type, 'dumps', None) or pickle.dumps
+
+        # ---- codec ----
+        if codec is None and value_type is SqliteStoreValue and not (converter or adapter):
+            codec = 'pickle'
+        self.codec = codecs[codec] if codec is not None else None
+        self.compressor = compressors[compress] if compress is not None else None
+        self.compress_threshold = compress_threshold
+
+        # ---- auto outdate ----
+        if outdate_cond:
+            assert callable(outdate_cond)
+        self._outdate_cond = outdate_cond
+        self._outdate_timing = timing
+
+        # ---- ttl ----
+        self.ttl = ttl
+        self._next_expiry = None
+
+        # ---- connections ----
+        self.pragmas = pragmas or {}
+        self.cached_statements = cached_statements
+        if path == ':memory:':
+            max_connections = 1
+        self.pool = ConnectionPool(self.get_db, max_connections)
+
+        # ---- indexed columns ----
+        self.columns = tuple(columns or ())
+        for name in self.columns:
+            assert name not in ('id', 'value', 'codec', 'key', 'expires_at'), 'reserved column name: %s' % name
+        self._column_getters = [_field_getter(name) for name in self.columns]
+
+        sql_vars = {
+            'tab': self.tab_name,
+            'cols': ''.join(', ' + quote_column(name) for name in self.columns),
+            'col_params': ', ?' * len(self.columns),
+        }
+        self._sql = dict(
+            (name, template % sql_vars)
+            for name, template in self.sql_templates.iteritems()
+        )
+        self._init_db()
+
+        # ---- write behind ----
+        self.write_behind = write_behind
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = []
+        self._pending_since = None
+        self._pending_cond = Condition(Lock())
+        self._closed = False
+        if self.write_behind:
+            make_thread(self._flusher, name='sqlitestore-flusher', daemon=True)
+
+        # ---- statistics ----
+        self.stats = _make_stats(stats)
+        self._entered = local()   # when the running API is called, for lock_wait
+        if self.stats is not None:
+            self.stats.gauge('pending', lambda: len(self._pending))
+
+        # ---- background maintenance ----
+        self._maintain_lock = Lock()
+        self.slice_size = 256       # rows per slice of maintain_step
+        self._scan_from = None      # id where an incremental outdate scan resumes
+        self._maintainer = None
+        if background:
+            self._maintainer = default_maintainer if background is True else background
+            self._maintainer.register(self)
+
+    #####################
+    # db logic
+    #####################
+
+    def _convert_value(self, raw_value):
+        """
+            sql -> python, by value_type
+        """
+        value = self._converter(raw_value)
+        if self.vtype is SqliteStoreValue:
+            value = value.value
+        return value
+
+    def _adapt_value(self, value):
+        """
+            python -> sql
+        """
+        raw = self._adapter(value)
+        return raw
+
+
+    def _init_db(self):
+        with self.pool.connection() as db:
+            db.execute(self._sql['create'])
+
+            existing = set(row[1] for row in db.execute('PRAGMA table_info(%s)' % self.tab_name))
+            if 'codec' not in existing:
+                # table of an older version, whose rows are all of value_type
+                db.execute('ALTER TABLE %s ADD COLUMN codec INTEGER' % self.tab_name)
+            if 'key' not in existing:
+                db.execute('ALTER TABLE %s ADD COLUMN key' % self.tab_name)
+            if 'expires_at' not in existing:
+                db.execute('ALTER TABLE %s ADD COLUMN expires_at REAL' % self.tab_name)
+            db.execute('CREATE INDEX IF NOT EXISTS %s ON %s(expires_at)' % (
+                quote_column('%s_expires_at' % self.tab_name), self.tab_name
+            ))
+            self._next_expiry = db.execute(self._sql['next_expiry']).fetchone()[0]
+            # NULL keys (values added by `add`) are not unique
+            db.execute('CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s(key)' % (
+                quote_column('%s_key' % self.tab_name), self.tab_name
+            ))
+            for name in self.columns:
+                if name not in existing:
+                    db.execute('ALTER TABLE %s ADD COLUMN %s' % (self.tab_name, quote_column(name)))
+                db.execute('CREATE INDEX IF NOT EXISTS %s ON %s(%s)' % (
+                    quote_column('%s_%s' % (self.tab_name, name)),
+                    self.tab_name,
+                    quote_column(name)
+                ))
+            db.commit()
+
+
+    def _encode(self, value):
+        """
+            python -> (raw, codec id)
+            codec id 0 means value_type.
+        """
+        if self.codec is None:
+            if not isinstance(value, self.vtype):
+                value = self.vtype(value)
+            return self._adapt_value(value), 0
+
+        if isinstance(value, SqliteStoreValue):
+            value = value.value
+        raw, codec_id = encode_value(value, self.codec, self.compressor, self.compress_threshold)
+        if self.stats is not None:
+            self.stats.incr('bytes_encoded', len(raw))
+        return sqlite3.Binary(raw), codec_id
+
+    def _decode(self, raw, codec_id):
+        """
+            (raw, codec id) -> python
+        """
+        if isinstance(raw, unicode):
+            raw = raw.encode('utf-8')
+        else:
+            raw = str(raw)
+        if self.stats is not None:
+            self.stats.incr('bytes_decoded', len(raw))
+
+        if not codec_id:
+            # NULL codec: written by an older version
+            return self._convert_value(raw)
+        return decode_value(raw, codec_id)
+
+    def _decode_rows(self, rows):
+        """
+            [(id, raw, codec id)] -> [(id, python value)]
+        """
+        decode = self._decode
+        rows = [(row_id, decode(raw, codec_id)) for row_id, raw, codec_id in rows]
+        if self.stats is not None:
+            self.stats.incr('rows_scanned', len(rows))
+        return rows
+
+
+    def _row(self, value, expires_at=None):
+        """
+            insert parameters of a value: (raw, codec id, expires_at, column values ...)
+        """
+        raw, codec_id = self._encode(value)
+        if not self.columns:
+            return (raw, codec_id, expires_at)
+
+        if isinstance(value, SqliteStoreValue):
+            record = value.value
+        else:
+            record = value
+        columns = []
+        for get in self._column_getters:
+            column = get(record)
+            if column is _missing:
+                columns.append(None)
+            else:
+                column = sql_scalar(column)
+                columns.append(_odd_column if column is None else column)
+        return (raw, codec_id, expires_at) + tuple(columns)
+
+    def _expires_at(self, options):
+        ttl = options.get('ttl', self.ttl)
+        return None if ttl is None else time() + ttl
+
+
+    def _scalar_columns(self, db, cond):
+        """
+            declared columns looked up by a Q, which hold only numbers, strings or NULL.
+        """
+        columns = []
+        for name in set(cond._fields()):
+            if name not in self.columns:
+                continue
+            sql = 'SELECT 1 FROM %s WHERE %s >= ? LIMIT 1' % (self.tab_name, quote_column(name))
+            if db.execute(sql, (_odd_column, )).fetchone() is None:
+                columns.append(name)
+        return columns
+
+    def _where(self, cond, db=None):
+        """
+            WHERE clause for a condition.
+            Q lookups on declared columns are done by SQL,
+            the rest is left to the caller, to be checked on decoded values.
+            input:
+                db -> connection, one is checked out of the pool if not given
+            output:
+                (where, params, the rest of cond)
+        """
+        if isinstance(cond, Q):
+            if db is None:
+                with self.pool.connection() as db:
+                    columns = self._scalar_columns(db, cond)
+            else:
+                columns = self._scalar_columns(db, cond)
+            sql, params, cond = cond.to_sql(columns)
+            if sql is not None:
+                # parenthesized, so that more terms can be ANDed to it
+                return ' WHERE (%s)' % sql, params, cond
+        if cond is not None:
+            assert callable(cond)
+        return '', [], cond
+
+
+    def get_db(self):
+        """
+            open a new connection, used by the pool.
+        """
+        db = sqlite3.connect(
+            self.dbpath,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        for name, value in sorted(self.pragmas.iteritems()):
+            db.execute('PRAGMA %s = %s' % (name, value))
+
+        return db
+
+
+    def close(self):
+        """
+            write buffered values, stop background threads and close all connections.
+        """
+        if self._maintainer is not None:
+            self._maintainer.unregister(self)
+        with self._pending_cond:
+            self._closed = True
+            self._pending_cond.notify_all()
+        self.flush()
+        self.pool.close()
+
+
+    ##########################################
+    # write behind
+    ##########################################
+
+    def _buffer(self, rows):
+        with self._pending_cond:
+            while True:
+                if self._closed:
+                    # no flusher would write them
+                    raise sqlite3.ProgrammingError('store is closed')
+                if not (self._pending and len(self._pending) + len(rows) > self.max_pending):
+                    break
+                # backpressure
+                self._pending_cond.notify_all()
+                self._pending_cond.wait()
+
+            if not self._pending:
+                # wake the flusher up to start timing flush_interval
+                self._pending_since = time()
+                self._pending_cond.notify_all()
+            self._pending.extend(rows)
+            if len(self._pending) >= self.batch_size:
+                self._pending_cond.notify_all()
+
+    def _flush(self):
+        """
+            write buffered rows in one transaction,
+            the writer lock, or the reader lock and _maintain_lock must be held.
+        """
+        with self._pending_cond:
+            rows, self._pending = self._pending, []
+            self._pending_cond.notify_all()
+        if not rows:
+            return
+
+        try:
+            self._insert_rows(rows)
+        except:
+            # keep them for the next flush
+            with self._pending_cond:
+                self._pending[:0] = rows
+                self._pending_since = time()
+            raise
+
+    def _flusher(self):
+        cond = self._pending_cond
+        while True:
+            with cond:
+                while True:
+                    if self._closed:
+                        return
+                    if not self._pending:
+                        cond.wait()
+                        continue
+                    if len(self._pending) >= self.batch_size:
+                        break
+                    remaining = self._pending_since + self.flush_interval - time()
+                    if remaining <= 0:
+                        break
+                    cond.wait(remaining)
+
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+                sleep(self.flush_interval)
+
+    def _check_fork(self):
+        """
+            called by APIs before they lock anything,
+            see SharedStore, which is used across fork.
+        """
+
+    @mthread_safe(mode='write')
+    def _flush_locked(self):
+        self._flush()
+
+    def flush(self):
+        """
+            write buffered values of write_behind mode.
+        """
+        self._check_fork()
+        self._flush_locked()
+
+
+    ##########################################
+    # maintainer: auto delete oudated records
+    ##########################################
+
+    @property
+    def maintain_deadline(self):
+        if not hasattr(self, '_maintain_deadline'):
+            if self._outdate_timing:
+                self._maintain_deadline = time() + self._outdate_timing
+            else:
+                self._maintain_deadline = None
+
+        return self._maintain_deadline
+
+
+    @maintain_deadline.setter
+    def maintain_deadline(self, value):
+        self._maintain_deadline = value
+
+
+    def _note_expiry(self, expires_at):
+        if expires_at is not None and (self._next_expiry is None or expires_at < self._next_expiry):
+            self._next_expiry = expires_at
+
+    def _expire(self, limit=None):
+        """
+            delete expired rows, at most `limit` rows if it's not None.
+            nothing is read from database until the earliest expiry time.
+            output:
+                number of deleted rows.
+        """
+        now = time()
+        if self._next_expiry is None or now < self._next_expiry:
+            return 0
+
+        with self.pool.connection() as db:
+            if limit is None:
+                cursor = db.execute(self._sql['expire'], (now, ))
+            else:
+                cursor = db.execute(self._sql['expire_limit'], (now, limit))
+            db.commit()
+            self._next_expiry = db.execute(self._sql['next_expiry']).fetchone()[0]
+        return cursor.rowcount
+
+    def maintain(self):
+        """
+            remove expired records,
+            and outdated records according to the returned value of outdate_cond
+        """
+        self._expire()
+
+        if not self._outdate_cond:
+            # no outdate condition, do not maintain.
+            return
+
+        if self._outdate_timing is None:
+            with self.pool.connection() as db:
+                self._exclude(db, self._outdate_cond, get_value=False)
+        else:
+            if time() >= self.maintain_deadline:
+                with self.pool.connection() as db:
+                    self._exclude(db, self._outdate_cond, get_value=False)
+                self.maintain_deadline = time() + self._outdate_timing
+
+    @mthread_safe(mode='write')
+    def _maintain_slice(self, size):
+        """
+            check at most `size` rows, return True if there's more to do.
+        """
+        if self._expire(size) >= size:
+            return True
+
+        if not self._outdate_cond:
+            return False
+
+        if self._scan_from is None:
+            if self._outdate_timing is not None and time() < self.maintain_deadline:
+                return False
+            self._scan_from = 0
+
+        with self.pool.connection() as db:
+            rows = self._decode_rows(db.execute(self._sql['scan'], (self._scan_from, size)))
+            ids = [(row_id, ) for row_id, value in rows if self._outdate_cond(value)]
+            if ids:
+                db.executemany(self._sql['delete_id'], ids)
+                db.commit()
+
+        if len(rows) < size:
+            # a pass is done
+            self._scan_from = None
+            if self._outdate_timing is not None:
+                self.maintain_deadline = time() + self._outdate_timing
+            return False
+
+        self._scan_from = rows[-1][0]
+        return True
+
+    def maintain_step(self, budget=0.005):
+        """
+            maintain incrementally, used by Maintainer.
+            the lock is held for one slice at a time.
+            input:
+                budget -> seconds to spend at most (roughly)
+            output:
+                bool -> if there's more to do.
+        """
+        deadline = time() + budget
+        while True:
+            more = self._maintain_slice(self.slice_size)
+            if not more or time() >= deadline:
+                return more
+
+    # decorators
+    def _maintained(method):
+        @wraps(method)
+        def new_method(self, *args, **kwargs):
+            stats = self.stats
+            if stats is not None:
+                locked = time()
+                entered = getattr(self._entered, 'time', None)
+                if entered is not None:
+                    self._entered.time = None
+                    stats.observe('lock_wait', locked - entered)
+
+            # readers run in parallel, but flush and maintain one by one
+            with self._maintain_lock:
+                if self._pending:
+                    self._flush()
+                if self._maintainer is None:
+                    self.maintain()
+                    if stats is not None:
+                        stats.observe('maintain', time() - locked)
+            return method(self, *args, **kwargs)
+        return new_method
+
+    def _measured_as(name):
+        """
+            measure the latency of an API (outside mthread_safe) under `name`,
+            the name of the method if None.
+            an API called by another one is measured as a part of it.
+            lock wait of a locked API is measured by _maintained.
+        """
+        def decorator(method):
+            api = name or method.__name__
+            @wraps(method)
+            def new_method(self, *args, **kwargs):
+                self._check_fork()
+                stats = self.stats
+                if stats is None:
+                    return method(self, *args, **kwargs)
+                entered = self._entered
+                start = entered.time = time()
+                if getattr(entered, 'api', None) is not None:
+                    return method(self, *args, **kwargs)
+                entered.api = api
+                try:
+                    return method(self, *args, **kwargs)
+                finally:
+                    entered.api = None
+                    stats.observe(api, time() - start)
+                    stats.report()
+            return new_method
+        return decorator
+
+    _measured = _measured_as(None)
+
+
+
+    ###################
+    # APIs
+    ###################
+
+    @_measured
+    @mthread_safe(mode='read')
+    @_maintained
+    def get_cols(self):
+
+        with self.pool.connection() as db:
+            cursor = db.execute(self._sql['cols'])
+            cursor.fetchall()
+            return [desc[0] for desc in cursor.description]
+
+
+    def _insert_rows(self, rows):
+        with self.pool.connection() as db:
+            db.executemany(self._sql['insert'], rows)
+            db.commit()
+        expiries = [row[2] for row in rows if row[2] is not None]
+        if expiries:
+            self._note_expiry(min(expiries))
+
+    @mthread_safe(mode='write')
+    @_maintained
+    def _add(self, rows):
+        self._insert_rows(rows)
+
+    @_measured
+    def add(self, *values, **options):
+        """
+            options:
+                ttl -> time-to-live of these values, default: self.ttl
+        """
+        if not values:
+            return
+
+        expires_at = self._expires_at(options)
+        rows = [self._row(v, expires_at) for v in values]
+        if self.write_behind:
+            self._buffer(rows)
+        else:
+            self._add(rows)
+
+
+    def _filter(self, db, filter_cond=None):
+        where, params, cond = self._where(filter_cond, db)
+
+        cursor = db.execute(self._sql['scan_where'] + where + ' ORDER BY id', params)
+        rows = self._decode_rows(cursor)
+        if cond is None:
+            values = [value for row_id, value in rows]
+        else:
+            values = [value for row_id, value in rows if cond(value)]
+        if self.stats is not None:
+            self.stats.incr('rows_returned', len(values))
+        return values
+
+
+    @_measured
+    @mthread_safe(mode='read')
+    @_maintained
+    def filter(self, filter_cond=None):
+        with self.pool.connection() as db:
+            return self._filter(db, filter_cond)
+
+
+    def _exclude(self, db, exclude_cond=None, get_value=True):
+        """
+            select and delete in one transaction,
+            which takes the write lock first, so no row can slip in between.
+            a python condition is checked on decoded rows, so each row is decoded once.
+        """
+        values = None
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            where, params, cond = self._where(exclude_cond, db)
+            if cond is None:
+                if get_value:
+                    cursor = db.execute(self._sql['scan_where'] + where + ' ORDER BY id', params)
+                    values = [value for row_id, value in self._decode_rows(cursor)]
+                db.execute(self._sql['delete'] + where, params)
+            else:
+                cursor = db.execute(self._sql['scan_where'] + where + ' ORDER BY id', params)
+                ids = []
+                values = []
+                for row_id, value in self._decode_rows(cursor):
+                    if cond(value):
+                        ids.append((row_id, ))
+                        values.append(value)
+                db.executemany(self._sql['delete_id'], ids)
+
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+        if get_value and self.stats is not None:
+            self.stats.incr('rows_returned', len(values))
+        return values if get_value else None
+
+    @_measured
+    @mthread_safe(mode='write')
+    @_maintained
+    def exclude(self, exclude_cond=None):
+        with self.pool.connection() as db:
+            return self._exclude(db, exclude_cond=exclude_cond)
+
+
+    ###################
+    # streaming APIs
+    ###################
+
+    def _keyset(self, cond):
+        """
+            statement reading a batch of rows after an id, with parameters
+            (where params ..., after id, batch size), and the python part of cond.
+        """
+        where, params, cond = self._where(cond)
+        sql = '%s%s%s id > ? ORDER BY id LIMIT ?' % (
+            self._sql['scan_where'], where, ' AND' if where else ' WHERE'
+        )
+        return sql, list(params), cond
+
+    @_measured_as('iter_filter')
+    @mthread_safe(mode='read')
+    @_maintained
+    def _read_batch(self, sql, params):
+        with self.pool.connection() as db:
+            return self._decode_rows(db.execute(sql, params))
+
+    @_measured_as('iter_exclude')
+    @mthread_safe(mode='write')
+    @_maintained
+    def _exclude_batch(self, sql, params, cond):
+        with self.pool.connection() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._decode_rows(db.execute(sql, params))
+                if cond is not None:
+                    matched = [(row_id, value) for row_id, value in rows if cond(value)]
+                else:
+                    matched = rows
+                db.executemany(self._sql['delete_id'], [(row_id, ) for row_id, value in matched])
+                db.commit()
+            except:
+                db.rollback()
+                raise
+        return rows, [value for row_id, value in matched]
+
+    def iter_filter(self, filter_cond=None, batch_size=1000):
+        """
+            generator of filtered values, in insertion order.
+            rows are read in batches of `batch_size` by id ranges,
+            the lock and the connection are only held while a batch is read,
+            so memory is bounded by batch_size however large the store is.
+            rows changed during the iteration may be seen or not.
+        """
+        sql, params, cond = self._keyset(filter_cond)
+        after = 0
+        while True:
+            rows = self._read_batch(sql, params + [after, batch_size])
+            for row_id, value in rows:
+                if cond is None or cond(value):
+                    yield value
+
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
+    def _exclude_batches(self, exclude_cond, batch_size):
+        """
+            generator of non-empty lists of excluded values,
+            each one is deleted in one transaction.
+        """
+        sql, params, cond = self._keyset(exclude_cond)
+        after = 0
+        while True:
+            rows, values = self._exclude_batch(sql, params + [after, batch_size], cond)
+            if values:
+                yield values
+
+            if len(rows) < batch_size:
+                return
+            after = rows[-1][0]
+
+    def iter_exclude(self, exclude_cond=None, batch_size=1000):
+        """
+            generator of excluded values, in insertion order.
+            like iter_filter, but each batch is deleted in one transaction
+            before its values are yielded.
+        """
+        for values in self._exclude_batches(exclude_cond, batch_size):
+            for value in values:
+                yield value
+
+    ###################
+    # key-value APIs
+    #   values put by key live in the same table,
+    #   so filter/exclude see them as well.
+    ###################
+
+    @staticmethod
+    def _check_key(key):
+        """
+            key as it's bound, see sql_scalar.
+            a str which is not UTF-8 is bound as a BLOB,
+            so it's the same key as the str, and no unicode.
+        """
+        bound = sql_scalar(key)
+        if bound is None and isinstance(key, str):
+            return sqlite3.Binary(key)
+        assert bound is not None, 'key must be a string, a number within 64 bits: %r' % (key, )
+        return bound
+
+    @staticmethod
+    def _key_of(bound):
+        """
+            hashable form of a bound key, or of a key column.
+        """
+        return str(bound) if isinstance(bound, buffer) else bound
+
+    @_measured
+    @mthread_safe(mode='write')
+    @_maintained
+    def put_many(self, items, **options):
+        """
+            insert or replace values by key.
+            input:
+                items -> dict, or iterable of (key, value)
+            options:
+                ttl -> time-to-live of these values, default: self.ttl
+        """
+        if isinstance(items, dict):
+            items = items.iteritems()
+        expires_at = self._expires_at(options)
+        rows = [(self._check_key(key), ) + self._row(value, expires_at) for key, value in items]
+        if not rows:
+            return
+        with self.pool.connection() as db:
+            db.executemany(self._sql['put'], rows)
+            db.commit()
+        self._note_expiry(expires_at)
+
+    @_measured
+    def put(self, key, value, **options):
+        """
+            insert or replace the value of key.
+        """
+        self.put_many([(key, value)], **options)
+
+    @_measured
+    @mthread_safe(mode='read')
+    @_maintained
+    def get(self, key, default=None):
+        with self.pool.connection() as db:
+            rows = self._decode_rows(db.execute(self._sql['get'], (self._check_key(key), )))
+        return rows[0][1] if rows else default
+
+    @_measured
+    @mthread_safe(mode='read')
+    @_maintained
+    def get_many(self, keys):
+        """
+            output:
+                dict, key -> value, missing keys are left out.
+        """
+        passed = {}     # bound key -> key as passed
+        bound = []
+        for key in keys:
+            bound.append(self._check_key(key))
+            passed[self._key_of(bound[-1])] = key
+        found = {}
+        with self.pool.connection() as db:
+            for i in xrange(0, len(bound), self.keys_per_query):
+                chunk = bound[i:i + self.keys_per_query]
+                sql = self._sql['get_many'] + '(%s)' % ', '.join('?' * len(chunk))
+                for key, value in self._decode_rows(db.execute(sql, chunk)):
+                    found[passed[self._key_of(key)]] = value
+        return found
+
+    @_measured
+    @mthread_safe(mode='read')
+    @_maintained
+    def contains(self, key):
+        with self.pool.connection() as db:
+            return db.execute(self._sql['contains'], (self._check_key(key), )).fetchone() is not None
+
+    __contains__ = contains
+
+    @_measured
+    @mthread_safe(mode='write')
+    @_maintained
+    def delete_many(self, keys):
+        """
+            output:
+                number of deleted values
+        """
+        rows = [(self._check_key(key), ) for key in keys]
+        with self.pool.connection() as db:
+            cursor = db.executemany(self._sql['delete_key'], rows)
+            db.commit()
+            return cursor.rowcount
+
+    @_measured
+    def delete(self, key):
+        """
+            output:
+                bool -> if the key existed
+        """
+        return self.delete_many([key]) > 0
+
+
+    @_measured
+    def reencode(self, batch_size=1000):
+        """
+            rewrite rows which are not encoded by the current codec and compressor,
+            e.g. after the codec of a store is changed.
+            rows are rewritten in batches, one transaction per batch.
+            output:
+                number of rewritten rows.
+        """
+        count = 0
+        after = 0
+        while True:
+            rows, rewritten = self._reencode_batch(after, batch_size)
+            count += rewritten
+            if len(rows) < batch_size:
+                return count
+            after = rows[-1][0]
+
+    @mthread_safe(mode='write')
+    def _reencode_batch(self, after, size):
+        with self.pool.connection() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = db.execute(self._sql['scan'], (after, size)).fetchall()
+                updates = []
+                for row_id, raw, codec_id in rows:
+                    value = self._decode(raw, codec_id)
+                    new_raw, new_codec_id = self._encode(value)
+                    if new_codec_id != (codec_id or 0):
+                        updates.append((new_raw, new_codec_id, row_id))
+                db.executemany(self._sql['update_value'], updates)
+                db.commit()
+            except:
+                db.rollback()
+                raise
+        return rows, len(updates)
+
+
+    del _maintained, _measured_as, _measured
+
+
+#####################
+# queue
+#####################
+
+class SqliteQueue(object):
+    """
+        A durable FIFO queue, in a table of a SqliteStore's database.
+        get() leases messages for visibility_timeout seconds instead of deleting them,
+        ack() deletes them, messages not acked in time are delivered again,
+        so every message is delivered at least once, even if a consumer crashes.
+        queries go by an index of (lease_until, id), each get() is O(batch).
+        Usage:
+            queue = SqliteQueue(SqliteStore(path))
+            queue.put_many([{'job': 1}, {'job': 2}])
+            for msg_id, value in queue.get(batch=10, visibility_timeout=60):
+                handle(value)
+                queue.ack([msg_id])
+    """
+
+    # lease_until: 0 -> ready, else leased until then (or delayed by nack)
+    sql_templates = {
+        'create': '''
+            CREATE TABLE IF NOT EXISTS %(tab)s(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                value BLOB,
+                codec INTEGER,
+                lease_until REAL NOT NULL DEFAULT 0
+            )
+        ''',
+        'index': 'CREATE INDEX IF NOT EXISTS %(index)s ON %(tab)s(lease_until, id)',
+        'put': 'INSERT INTO %(tab)s(value, codec) VALUES(?, ?)',
+        'release': '''
+            UPDATE %(tab)s SET lease_until = 0 WHERE id IN (
+                SELECT id FROM %(tab)s WHERE lease_until > 0 AND lease_until <= ? LIMIT ?
+            )
+        ''',
+        'ready': 'SELECT id, value, codec FROM %(tab)s WHERE lease_until = 0 ORDER BY id LIMIT ?',
+        'lease': 'UPDATE %(tab)s SET lease_until = ? WHERE id = ?',
+        'ack': 'DELETE FROM %(tab)s WHERE id = ?',
+        'count': 'SELECT count(*) FROM %(tab)s',
+    }
+
+    def __init__(self, store=None, name='litequeue'):
+        """
+            input:
+                store -> a SqliteStore, whose connections and codec are used,
+                         default: a new one in memory.
+                name -> table name of the queue, queues of different names are independent.
+        """
+        self.store = store if store is not None else SqliteStore()
+        self.name = name
+        sql_vars = {'tab': quote_column(name), 'index': quote_column('%s_lease' % name)}
+        self._sql = dict(
+            (key, template % sql_vars)
+            for key, template in self.sql_templates.iteritems()
+        )
+        with self.store.pool.connection() as db:
+            db.execute(self._sql['create'])
+            db.execute(self._sql['index'])
+            db.commit()
+
+    def put_many(self, values):
+        rows = [self.store._encode(value) for value in values]
+        if not rows:
+            return
+        with self.store.pool.connection() as db:
+            db.executemany(self._sql['put'], rows)
+            db.commit()
+
+    def put(self, value):
+        self.put_many([value])
+
+    def get(self, batch=1, visibility_timeout=30):
+        """
+            lease at most `batch` messages, in FIFO order,
+            messages whose lease is over are back in the queue by their ids.
+            output:
+                [(message id, value)], may be empty.
+        """
+        now = time()
+        with self.store.pool.connection() as db:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute(self._sql['release'], (now, batch))
+                messages = self.store._decode_rows(db.execute(self._sql['ready'], (batch, )))
+                lease_until = now + visibility_timeout
+                db.executemany(self._sql['lease'], [(lease_until, msg_id) for msg_id, value in messages])
+                db.commit()
+            except:
+                db.rollback()
+                raise
+        return messages
+
+    def ack(self, ids):
+        """
+            delete handled messages.
+            output:
+                number of deleted messages
+        """
+        with self.store.pool.connection() as db:
+            cursor = db.executemany(self._sql['ack'], [(msg_id, ) for msg_id in ids])
+            db.commit()
+            return cursor.rowcount
+
+    def nack(self, ids, delay=0):
+        """
+            give messages back to the queue,
+            they are delivered again after `delay` seconds.
+        """
+        lease_until = time() + delay if delay > 0 else 0
+        with self.store.pool.connection() as db:
+            db.executemany(self._sql['lease'], [(lease_until, msg_id) for msg_id in ids])
+            db.commit()
+
+    def __len__(self):
+        """
+            number of messages, leased ones included.
+        """
+        with self.store.pool.connection() as db:
+            return db.execute(self._sql['count']).fetchone()[0]
+
+
+#####################
+# sharding
+#####################
+
+class ShardedSqliteStore(object):
+    """
+        SqliteStores on several database files, whose writes do not block each other.
+        added values are spread round-robin, values put by key go to the shard of the key.
+        filter/exclude run on all shards in parallel,
+        results are in insertion order within each shard, shard by shard.
+        iter_filter/iter_exclude go through shards one by one.
+        APIs: the same as SqliteStore
+    """
+
+    def __init__(self, paths, **options):
+        """
+            input:
+                paths -> database files of shards, e.g. on different disks.
+                         the order matters: keys are found by their shard number.
+                options -> see SqliteStore, passed to every shard.
         """
-        return self.cache[given]
-
-    # @_threadsafe
-    @mthread_safe()
-    @_maintained
-    def add(self, *records):
+        assert len(paths) >= 1
+        self.shards = [SqliteStore(path, **options) for path in paths]
+        self._next = 0
+        self._lock = Lock()
+        # the calling thread takes one shard of a fan-out
+        self._pool = ThreadPool(0, max(1, len(paths) - 1), name='sqlitestore-shard')
+
+    def _shard_of(self, key):
+        # stable across processes, unlike hash()
+        key = SqliteStore._check_key(key)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return zlib.crc32(str(key)) % len(self.shards)
+
+    def _fan_out(self, calls, **options):
         """
-            append records to cache.
+            run calls [(shard, method name, args)] in parallel,
+            with keyword arguments `options`.
+            output:
+                results in the order of calls.
         """
-        self.cache.extend(records)
+        if not calls:
+            return []
 
-    # @_threadsafe
-    @mthread_safe()
-    @_maintained
-    def filter(self, filter_cond=None):
+        futures = [
+            self._pool.submit(getattr(shard, name), *args, **options)
+            for shard, name, args in calls[1:]
+        ]
+
+        # the first one runs in this thread
+        shard, name, args = calls[0]
+        first = getattr(shard, name)(*args, **options)
+        return [first] + [future.result() for future in futures]
+
+    def _all(self, name, *args):
+        return self._fan_out([(shard, name, args) for shard in self.shards])
+
+    def _by_key(self, name, keys, make_args, **options):
         """
-            filter cached message with callback filter_cond
+            group keys by shard and call `name` with make_args(keys of the shard).
         """
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._shard_of(key), []).append(key)
+        return self._fan_out([
+            (self.shards[i], name, make_args(shard_keys))
+            for i, shard_keys in sorted(groups.iteritems())
+        ], **options)
+
+    def add(self, *values, **options):
+        n = len(self.shards)
+        with self._lock:
+            start = self._next
+            self._next = (start + len(values)) % n
+
+        self._fan_out([
+            (self.shards[(start + i) % n], 'add', values[i::n])
+            for i in xrange(min(n, len(values)))
+        ], **options)
 
-        if filter_cond:
-            assert callable(filter_cond)
-            return filter(filter_cond, self.cache)
-        else:
-            return copy(self.cache)
+    def filter(self, filter_cond=None):
+        return [value for values in self._all('filter', filter_cond) for value in values]
 
-    # @_threadsafe
-    @mthread_safe()
-    @_maintained
     def exclude(self, exclude_cond=None):
-        """
-            exclude cached data according to exclude_cond
-        """
+        return [value for values in self._all('exclude', exclude_cond) for value in values]
 
-        return self._exclude(exclude_cond)
+    def iter_filter(self, filter_cond=None, batch_size=1000):
+        for shard in self.shards:
+            for value in shard.iter_filter(filter_cond, batch_size):
+                yield value
 
-    del _maintained
-    # del _threadsafe
+    def iter_exclude(self, exclude_cond=None, batch_size=1000):
+        for shard in self.shards:
+            for value in shard.iter_exclude(exclude_cond, batch_size):
+                yield value
 
+    def get_cols(self):
+        # shards are made by the same options
+        return self.shards[0].get_cols()
 
-try:
-    import cPickle as pickle
-except ImportError, e:
-    warnings.warn('no cPickle module.')
-    import pickle
+    def put_many(self, items, **options):
+        if isinstance(items, dict):
+            items = items.iteritems()
+        items = dict(items)
+        self._by_key('put_many', items, lambda keys: ([(key, items[key]) for key in keys], ), **options)
 
+    def put(self, key, value, **options):
+        self.shards[self._shard_of(key)].put(key, value, **options)
 
-class SqliteStoreValue(object):
-    def __init__(self, value):
-        self.value = value
+    def get(self, key, default=None):
+        return self.shards[self._shard_of(key)].get(key, default)
 
-    @staticmethod
-    def dumps(store_v):
-        assert isinstance(store_v, SqliteStoreValue)
-        return pickle.dumps(store_v.value)
+    def get_many(self, keys):
+        found = {}
+        for shard_found in self._by_key('get_many', keys, lambda keys: (keys, )):
+            found.update(shard_found)
+        return found
 
-    @staticmethod
-    def loads(raw):
-        return SqliteStoreValue(pickle.loads(raw))
+    def contains(self, key):
+        return self.shards[self._shard_of(key)].contains(key)
 
+    __contains__ = contains
 
-class SqliteStore(object):
+    def delete_many(self, keys):
+        return sum(self._by_key('delete_many', keys, lambda keys: (keys, )))
 
-    tab_name = 'litestore'
+    def delete(self, key):
+        return self.shards[self._shard_of(key)].delete(key)
 
-    def __init__(self, path=':memory:', outdate_cond=None, timing=None, value_type=SqliteStoreValue, converter=None, adapter=None):
-        self.vtype= value_type
-        self.dbpath = path
-        self.vtype_name = value_type.__name__
+    def reencode(self, batch_size=1000):
+        return sum(self._all('reencode', batch_size))
 
-        # ---- value_type.loads and value_type.dumps must be staticmethod ----
-        # be careful with pickle.
-        self._converter = converter or getattr(value_type, 'loads', None) or pickle.loads
-        self._adapter = adapter or getattr(value_type, 'dumps', None) or pickle.dumps
+    def maintain(self):
+        self._all('maintain')
 
-        # ---- auto outdate ----
-        if outdate_cond:
-            assert callable(outdate_cond)
-        self._outdate_cond = outdate_cond
-        self._outdate_timing = timing
+    def flush(self):
+        self._all('flush')
 
+    def close(self):
+        self._all('close')
+        self._pool.shutdown()
 
-        self.local = local()
-        self._init_db()
 
-    #####################
-    # db logic
-    #####################
+#####################
+# shared by processes
+#####################
 
-    def _convert_value(self, raw_value):
+class SharedStore(SqliteStore):
+    """
+        A SqliteStore shared by processes on one host, e.g. pre-forked workers.
+        the database lives in shared memory (tmpfs), in WAL mode and mapped by mmap,
+        so readers do not block the writer, and every process sees the same data.
+        APIs are the same as SqliteStore.
+        Usage:
+            store = SharedStore('sessions')     # create before fork, warm up once
+            ... fork workers, which use `store` (or SharedStore('sessions')) ...
+            store.destroy()                     # remove it when all are done
+    """
+
+    shm_dir = '/dev/shm'
+
+    # seconds, values added by other processes are expired this late at most
+    expiry_poll = 1.0
+
+    default_pragmas = {
+        'journal_mode': 'WAL',
+        # nothing survives a reboot in tmpfs anyway
+        'synchronous': 'OFF',
+        'mmap_size': 268435456,
+        'busy_timeout': 10000,
+    }
+
+    def __init__(self, name, shm_dir=None, pragmas=None, **options):
         """
-            sql -> python
+            input:
+                name -> name of the store, stores of the same name are the same one.
+                shm_dir -> directory of the database, default: /dev/shm if exists,
+                           else the temporary directory.
+                pragmas -> override default_pragmas.
+                options -> see SqliteStore, except path.
+                           background runs in the creating process only,
+                           with write_behind, every process buffers and flushes its own values.
         """
-        value = self._converter(raw_value.encode('utf-8'))
-        if self.vtype is SqliteStoreValue:
-            value = value.value
-        return value
-
-    def _adapt_value(self, value):
+        if shm_dir is None:
+            shm_dir = self.shm_dir if os.path.isdir(self.shm_dir) else tempfile.gettempdir()
+        self.name = name
+        path = os.path.join(shm_dir, 'pyutils-%s.db' % name)
+
+        self._pid = os.getpid()
+        self._fork_lock = Lock()
+        self._expiry_polled = 0
+        all_pragmas = dict(self.default_pragmas)
+        all_pragmas.update(pragmas or {})
+        SqliteStore.__init__(self, path, pragmas=all_pragmas, **options)
+
+    def _check_fork(self):
         """
-            python -> sql
+            in a forked process, make new locks, which threads of the parent may have held,
+            drop values buffered by the parent (which writes them),
+            and start a flusher, threads do not survive fork.
+            the connection pool resets itself.
         """
-        raw = self._adapter(value)
-        return raw
+        if self._pid == os.getpid():
+            return
+        with self._fork_lock:
+            if self._pid == os.getpid():
+                return
+            self._thread_lock_ = RWLock()
+            self._maintain_lock = Lock()
+            self._entered = local()
+            self._pending_cond = Condition(Lock())
+            self._pending = []
+            self._pending_since = None
+            if self.write_behind and not self._closed:
+                make_thread(self._flusher, name='sqlitestore-flusher', daemon=True)
+            self._pid = os.getpid()
+
+    def _buffer(self, rows):
+        self._check_fork()
+        SqliteStore._buffer(self, rows)
+
+    def _flush(self):
+        self._check_fork()
+        SqliteStore._flush(self)
+
+    def _expire(self, limit=None):
+        # values with ttl may be added by other processes,
+        # the earliest expiry is read again every expiry_poll seconds
+        now = time()
+        if now >= self._expiry_polled + self.expiry_poll:
+            self._expiry_polled = now
+            with self.pool.connection() as db:
+                self._next_expiry = db.execute(self._sql['next_expiry']).fetchone()[0]
+        return SqliteStore._expire(self, limit)
+
+    def destroy(self):
+        """
+            close the store and remove its files.
+        """
+        self.close()
+        for suffix in ('', '-wal', '-shm'):
+            try:
+                os.remove(self.dbpath + suffix)
+            except OSError:
+                pass
 
 
-    def _init_db(self):
-        sqlite3.register_adapter(self.vtype, self._adapt_value)
-        sqlite3.register_converter(self.vtype_name, self._convert_value)
+#####################
+# tiered cache
+#####################
 
-        self.db.execute('''
-            CREATE TABLE IF NOT EXISTS %s(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                value %s
-            )
-        ''' % (self.tab_name, self.vtype_name))
-        self.db.commit()
+class TieredCache(object):
+    """
+        A key-value cache of two tiers:
+            memory -> SimpleCache of (key, value) records, bounded by max_items/max_bytes.
+            store -> SqliteStore in key-value mode.
+        hot values are read from memory,
+        values evicted from memory spill to the store,
+        and are promoted back to memory when they are read again.
+        APIs:
+            get, get_many, put, put_many, contains, delete, flush, close
+        counters:
+            hits -> found in memory
+            store_hits -> found in store
+            misses -> found in neither
+    """
 
+    write_policies = ('through', 'behind')
 
-    def _check_filter(self, raw_value):
-        value = self._convert_value(raw_value)
-        return self._filter_cond(value) if getattr(self, '_filter_cond', None) else True
+    def __init__(self, store=None, max_items=1000, max_bytes=None, policy='lru', sizeof=sys.getsizeof,
+                 write='through', loader=None):
+        """
+            input:
+                store -> a SqliteStore, default: a new one in memory.
+                         values are kept by key, so other rows of the store are left alone.
+                max_items, max_bytes, policy ->
+                        bound of the memory tier, see SimpleCache.
+                        sizeof is called with (key, value) records.
+                write -> 'through': put writes both tiers.
+                         'behind': put writes memory only,
+                                   values are written to the store when they are evicted,
+                                   or by flush() and close().
+                loader -> read-through callback, loader(key) returns the value of a key
+                          found in neither tier, the value is put into the cache.
+                          if None, missing keys are missing.
+        """
+        assert write in self.write_policies, 'unknown write policy: %s' % write
+        assert max_items is not None or max_bytes is not None, 'memory tier must be bounded'
+        if loader is not None:
+            assert callable(loader)
+
+        self.store = store if store is not None else SqliteStore()
+        self.write = write
+        self.loader = loader
+
+        self._evicted = []      # records evicted by the last memory write
+        self._dirty = {}        # key -> value, written to memory only (write='behind')
+        self._writes = 0        # number of writes which may make values read from store stale
+        self.memory = SimpleCache(
+            indexes={'key': operator.itemgetter(0)},
+            max_items=max_items, max_bytes=max_bytes, policy=policy, sizeof=sizeof,
+            on_evict=self._evicted.append, policy_key='key'
+        )
+
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+
+    def _cache(self, items, dirty):
+        """
+            put (key, value) items into memory, and spill the evicted dirty ones.
+        """
+        self.memory.add(*items, replace='key')
+        if dirty:
+            self._dirty.update(items)
+
+        evicted, self._evicted[:] = list(self._evicted), []
+        spilled = [
+            (key, self._dirty.pop(key)) for key, _ in evicted
+            if key in self._dirty
+        ]
+        if spilled:
+            self._writes += 1
+            self.store.put_many(spilled)
 
-    def _check_exclude(self, raw_value):
-        value = self._convert_value(raw_value)
-        return self._exc_cond(value) if getattr(self, '_exc_cond', None) else True
+    @mthread_safe()
+    def _lookup_memory(self, keys):
+        """
+            output:
+                (dict, key -> value of keys found in memory, number of writes so far)
+        """
+        found = {}
+        for key in keys:
+            records = self.memory.get_by('key', key)
+            if records:
+                found[key] = records[-1][1]
+        self.hits += len(found)
+        return found, self._writes
 
+    @mthread_safe()
+    def _promote(self, promoted, missed, writes):
+        self.store_hits += len(promoted)
+        self.misses += missed
+        # values written since the store was read may be newer than the promoted ones
+        if promoted and writes == self._writes:
+            self._cache(promoted.items(), False)
+
+    def _lookup(self, keys):
+        """
+            the store is read unlocked, so a cold read does not block hot ones.
+            output:
+                dict, key -> value of keys found in either tier.
+        """
+        found, writes = self._lookup_memory(keys)
+        rest = [key for key in keys if key not in found]
+        if rest:
+            promoted = self.store.get_many(rest)
+            self._promote(promoted, len(rest) - len(promoted), writes)
+            found.update(promoted)
+        return found
+
+    def get_many(self, keys):
+        """
+            output:
+                dict, key -> value, missing keys (not loaded by loader) are left out.
+        """
+        keys = list(keys)
+        found = self._lookup(keys)
+        if self.loader is not None:
+            # loader runs unlocked, concurrent loads of one key are both put
+            loaded = [(key, self.loader(key)) for key in keys if key not in found]
+            if loaded:
+                self.put_many(loaded)
+                found.update(loaded)
+        return found
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
 
-    def get_db(self):
+    @mthread_safe()
+    def put_many(self, items):
+        """
+            insert or replace values by key.
+            input:
+                items -> dict, or iterable of (key, value)
+        """
+        if isinstance(items, dict):
+            items = items.iteritems()
+        items = list(items)
+        for key, _ in items:
+            SqliteStore._check_key(key)
+        if not items:
+            return
+        self._writes += 1
+        if self.write == 'through':
+            self.store.put_many(items)
+        self._cache(items, self.write == 'behind')
 
-        db = sqlite3.connect(self.dbpath, detect_types=sqlite3.PARSE_DECLTYPES)
-        db.create_function('check_filter', 1, self._check_filter)
-        db.create_function('check_exclude', 1, self._check_exclude)
+    def put(self, key, value):
+        self.put_many([(key, value)])
 
-        return db
+    @mthread_safe()
+    def _in_memory(self, key):
+        return key in self._dirty or bool(self.memory.get_by('key', key))
 
+    def contains(self, key):
+        return self._in_memory(key) or key in self.store
 
-    @property
-    def db(self):
-        if not hasattr(self.local, 'db'):
-            self.local.db = self.get_db()
+    __contains__ = contains
 
-        return self.local.db
+    @mthread_safe()
+    def delete(self, key):
+        """
+            output:
+                bool -> if the key existed in either tier
+        """
+        self._writes += 1
+        self._dirty.pop(key, None)
+        in_memory = bool(self.memory.exclude_by('key', key))
+        in_store = self.store.delete(key)
+        return in_memory or in_store
 
+    @mthread_safe()
+    def flush(self):
+        """
+            write values which are in memory only to the store.
+        """
+        if self._dirty:
+            self.store.put_many(self._dirty.items())
+            self._dirty = {}
 
-    ##########################################
-    # maintainer: auto delete oudated records
-    ##########################################
+    def close(self):
+        self.flush()
+        self.store.close()
 
-    @property
-    def maintain_deadline(self):
-        if not hasattr(self, '_maintain_deadline'):
-            if self._outdate_timing:
-                self._maintain_deadline = time() + self._outdate_timing
-            else:
-                self._maintain_deadline = None
 
-        return self._maintain_deadline
+#####################
+# non-blocking facades
+#   methods return Future instead of blocking the caller,
+#   writes run in order in one writer thread, reads in reader threads.
+#   a read may run before a write submitted earlier,
+#   wait for the write's future to read what it writes.
+#####################
 
+def _async_method(name, write):
+    def method(self, *args, **kwargs):
+        return self._submit(write, getattr(self.store, name), args, kwargs)
+    method.__name__ = name
+    method.__doc__ = '%s of the store in the %s thread, return a Future.' % (
+        name, 'writer' if write else 'reader')
+    return method
 
-    @maintain_deadline.setter
-    def maintain_deadline(self, value):
-        self._maintain_deadline = value
 
+class _AsyncFacade(object):
 
-    def maintain(self):
+    def __init__(self, store, readers=4):
         """
-            remove outdated records,
-            according to the returned value of outdate_cond
+            input:
+                store -> the wrapped store
+                readers -> number of reader threads
         """
-        if not self._outdate_cond:
-            # no outdate condition, do not maintain.
-            return
+        assert readers >= 1
+        self.store = store
+        self._pools = {
+            True: ThreadPool(1, name='async-writer'),
+            False: ThreadPool(readers, name='async-reader'),
+        }
 
-        if self._outdate_timing is None:
-            self._exclude(self._outdate_cond, get_value=False)
-        else:
-            if time() >= self.maintain_deadline:
-                self._exclude(self._outdate_cond, get_value=False)
-                self.maintain_deadline = time() + self._outdate_timing
+    def _submit(self, write, func, args=(), kwargs={}):
+        return self._pools[write].submit(func, *args, **kwargs)
 
-    # decorator
-    def _maintained(method):
-        def new_method(self, *args, **kwargs):
-            self.maintain()
-            return method(self, *args, **kwargs)
-        return new_method
+    def _batches(self, write, take, prefetch=True):
+        """
+            generator of lists returned by take() until an empty one.
+            with prefetch, the next batch is taken while the caller handles the current one,
+            otherwise it is only taken when the caller asks for it,
+            which a take with side effects (iter_exclude) needs.
+        """
+        future = self._submit(write, take)
+        while True:
+            batch = future.result()
+            if not batch:
+                return
+            if prefetch:
+                future = self._submit(write, take)
+                yield batch
+            else:
+                yield batch
+                future = self._submit(write, take)
 
+    def close(self):
+        """
+            finish submitted calls, stop the threads,
+            then close the store if it has close().
+        """
+        for pool in self._pools.itervalues():
+            pool.shutdown()
+        if hasattr(self.store, 'close'):
+            self.store.close()
 
 
-    ###################
-    # APIs
-    ###################
+class AsyncSimpleCache(_AsyncFacade):
+    """
+        SimpleCache, whose APIs return Future.
+        Usage:
+            cache = AsyncSimpleCache(SimpleCache())
+            cache.add({'v': 1}).result()
+            print cache.filter().result()
+    """
 
-    @mthread_safe()
-    @_maintained
-    def get_cols(self):
+    add = _async_method('add', True)
+    exclude = _async_method('exclude', True)
+    exclude_by = _async_method('exclude_by', True)
 
-        cursor = self.db.execute("SELECT * FROM %s LIMIT 1;" % self.tab_name)
-        cursor.fetchall()
-        return [desc[0] for desc in cursor.description]
+    filter = _async_method('filter', False)
+    get_by = _async_method('get_by', False)
+    snapshot = _async_method('snapshot', False)
 
 
-    @mthread_safe()
-    @_maintained
-    def add(self, *values):
-        if not values:
-            return
+class AsyncSqliteStore(_AsyncFacade):
+    """
+        SqliteStore, whose APIs return Future.
+        since writes go through one thread, one connection of the pool does all writes.
+        Usage:
+            store = AsyncSqliteStore(SqliteStore(path))
+            store.put('k', {'v': 1}).result()
+            future = store.get('k')
+            ...
+            print future.result()
+    """
+
+    add = _async_method('add', True)
+    exclude = _async_method('exclude', True)
+    put = _async_method('put', True)
+    put_many = _async_method('put_many', True)
+    delete = _async_method('delete', True)
+    delete_many = _async_method('delete_many', True)
+    flush = _async_method('flush', True)
+    reencode = _async_method('reencode', True)
+
+    filter = _async_method('filter', False)
+    get = _async_method('get', False)
+    get_many = _async_method('get_many', False)
+    contains = _async_method('contains', False)
+
+    def iter_filter(self, filter_cond=None, batch_size=1000):
+        """
+            generator of batches (lists) of filtered values, in insertion order.
+            batches are read by reader threads, one batch ahead of the caller.
+        """
+        values = self.store.iter_filter(filter_cond, batch_size)
+        return self._batches(False, lambda: list(islice(values, batch_size)))
+
+    def iter_exclude(self, exclude_cond=None, batch_size=1000):
+        """
+            generator of batches (lists) of excluded values, in insertion order.
+            a batch is what the store deletes in one transaction,
+            at most batch_size values, fewer if a python condition leaves rows out.
+            batches are deleted by the writer thread when the caller asks for them,
+            so rows of batches the caller never receives are kept.
+        """
+        batches = self.store._exclude_batches(exclude_cond, batch_size)
+        return self._batches(True, lambda: next(batches, []), prefetch=False)
 
-        values = [
-                (v if isinstance(v, self.vtype) else self.vtype(v), )
-                for v in values
-            ]
-        self.db.executemany('INSERT INTO %s(value) VALUES(?)' % self.tab_name, values)
-        self.db.commit()
 
+#####################
+# memoize
+#####################
 
-    def _filter(self, filter_cond=None):
-        self._filter_cond = filter_cond
+def _plain_key(args, kwargs):
+    return (args, tuple(sorted(kwargs.iteritems()))) if kwargs else args
 
-        cursor = self.db.execute('SELECT value FROM %s WHERE check_filter(value);' % self.tab_name)
-        values = [row[0] for row in cursor.fetchall()]
-        # if self.vtype is SqliteStoreValue:
-        #     values = [v.value for v in values]
 
-        self._filter_cond = None
-        return values
+def _default_key(args, kwargs):
+    key = _plain_key(args, kwargs)
+    try:
+        hash(key)
+    except TypeError:
+        # unhashable arguments, e.g. lists and dicts
+        key = pickle.dumps(key, 2)
+    return key
 
 
-    @mthread_safe()
-    @_maintained
-    def filter(self, filter_cond=None):
-        return self._filter(filter_cond)
+def _stable_repr(value):
+    """
+        repr of plain values: None, numbers, strings, and tuples, lists, dicts and sets of them,
+        which is the same in every process.
+        None for other values, e.g. objects, whose repr has their address.
+    """
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return repr(value)
+
+    if isinstance(value, dict):
+        items = [(_stable_repr(k), _stable_repr(v)) for k, v in value.iteritems()]
+        if any(k is None or v is None for k, v in items):
+            return None
+        return '{%s}' % ', '.join('%s: %s' % item for item in sorted(items))
+
+    if isinstance(value, (tuple, list, set, frozenset)):
+        items = [_stable_repr(v) for v in value]
+        if None in items:
+            return None
+        if isinstance(value, tuple):
+            return '(%s%s)' % (', '.join(items), ',' if len(items) == 1 else '')
+        if isinstance(value, list):
+            return '[%s]' % ', '.join(items)
+        return '%s([%s])' % (type(value).__name__, ', '.join(sorted(items)))
+    return None
+
+
+class _Memo(object):
+    """
+        results of one memoized function.
+    """
 
+    def __init__(self, func, max_items=1000, ttl=None, policy='lru', key=None, store=None):
+        if key is not None:
+            assert callable(key)
+        self.func = func
+        self.key = key or _default_key
+        self.ttl = ttl
+        self.store = store
+        self.name = '%s.%s' % (func.__module__, func.__name__)
+        self.cache = SimpleCache(
+            indexes={'key': operator.itemgetter(0)},
+            ttl=ttl, max_items=max_items, policy=policy, policy_key='key'
+        )
+
+        self._lock = Lock()
+        self._running = {}      # key -> Future of the running call
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def __call__(self, *args, **kwargs):
+        key = self.key(args, kwargs)
+        records = self.cache.get_by('key', key)
+        if records:
+            self._count('hits')
+            return records[-1][1]
+
+        # one call per key, the others wait for its result
+        with self._lock:
+            future = self._running.get(key)
+            running = future is not None
+            if not running:
+                future = self._running[key] = Future()
+        if running:
+            self._count('waits')
+            return future.result()
+
+        try:
+            future.run(self._load, key, args, kwargs)
+        finally:
+            with self._lock:
+                del self._running[key]
+        return future.result()
+
+    def _store_key(self, key, args, kwargs):
+        if self.key is _default_key:
+            # arguments, before they're pickled
+            key = _plain_key(args, kwargs)
+        text = _stable_repr(key)
+        assert text is not None, \
+            'keys of %s in a store must be plain values, pass `key` (leaving self out for methods): %r' % (
+                self.name, key)
+        return '%s:%s' % (self.name, text)
+
+    def _load(self, key, args, kwargs):
+        # it may be done just before this call got the key
+        records = self.cache.get_by('key', key)
+        if records:
+            self._count('hits')
+            return records[-1][1]
+
+        value = _missing
+        if self.store is not None:
+            store_key = self._store_key(key, args, kwargs)
+            value = self.store.get(store_key, _missing)
+        if value is _missing:
+            self._count('misses')
+            value = self.func(*args, **kwargs)
+            if self.store is not None:
+                self.store.put(store_key, value, ttl=self.ttl)
+        else:
+            self._count('store_hits')
 
-    def _exclude(self, exclude_cond=None, get_value=True):
-        self._exc_cond = exclude_cond
+        self.cache.add((key, value))
+        return value
 
-        values = None
-        if get_value:
-            cursor = self.db.execute('SELECT value FROM %s WHERE check_exclude(value);' % self.tab_name)
-            values = [row[0] for row in cursor.fetchall()]
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'store_hits': self.store_hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'evictions': self.cache.evictions,
+                'size': len(self.cache.snapshot()),
+            }
+
+    def clear(self):
+        """
+            drop results in memory, results in the store are kept.
+        """
+        self.cache.exclude()
 
-        self.db.execute('DELETE FROM %s WHERE check_exclude(value);' % self.tab_name)
-        self.db.commit()
 
-        self._exc_cond = None
-        return values
+def memoize(**options):
+    """
+        cache results of the decorated function (or method) by its arguments.
+        options:
+            max_items -> max number of results in memory, default: 1000
+            ttl -> seconds a result is valid, default: None, forever
+            policy -> eviction policy, see SimpleCache, default: 'lru'
+            key -> callable(args, kwargs) returns the cache key of a call,
+                   default: args and kwargs if they're hashable, else pickled.
+                   for methods, args include self (which is kept alive by the cache).
+            store -> a SqliteStore, results are also put into it by
+                     "module.function:repr(key)", and read from it on memory misses,
+                     so they survive restarts.
+                     keys must be plain values (numbers, strings, and containers of them),
+                     whose repr is the same in every process,
+                     so methods need a `key` which leaves self out, or returns an id of it.
+        only one call per key runs at a time, concurrent calls of the same key
+        wait for its result (exceptions are raised to all of them, not cached).
+        the decorated function has:
+            stats() -> dict of hits, store_hits, misses (calls of the function),
+                       waits (calls waited for a running one), evictions, size
+            clear() -> drop results in memory
+        Example:
+            @memoize(max_items=100, ttl=60)
+            def fetch(url):
+                return urllib2.urlopen(url).read()
+    """
+    def decorator(func):
+        assert callable(func)
+        memo = _Memo(func, **options)
 
-    @mthread_safe()
-    @_maintained
-    def exclude(self, exclude_cond=None):
-        return self._exclude(exclude_cond=exclude_cond)
+        @wraps(func)
+        def new_func(*args, **kwargs):
+            return memo(*args, **kwargs)
 
+        new_func.stats = memo.stats
+        new_func.clear = memo.clear
+        return new_func
 
-    del _maintained
+    return decorator
 
 
 #####################
@@ -515,6 +3657,393 @@ class TestSqliteStore(unittest.TestCase):
         self.assertTrue(msgs[1] not in fmsgs)
 
 
+    def test_background_outdate(self):
+        import time, tempfile, shutil, os
+
+        tmpdir = tempfile.mkdtemp()
+        maintainer = Maintainer(interval=0.05)
+        cache = SqliteStore(
+            os.path.join(tmpdir, 'test.db'),
+            outdate_cond=lambda d: d['v'] % 3 == 0,
+            background=maintainer
+        )
+        cache.slice_size = 10
+        try:
+            cache.add(*[{'v': i} for i in range(50)])
+            time.sleep(0.5)
+            self.assertEqual(len(cache.filter()), 33)
+        finally:
+            maintainer.unregister(cache)
+            shutil.rmtree(tmpdir)
+
+    def test_memory_shared_by_threads(self):
+        from threading import Thread
+
+        cache = SqliteStore()
+        cache.add({'v': 1})
+        result = []
+        t = Thread(target=lambda: result.extend(cache.filter()))
+        t.start()
+        t.join()
+        self.assertEqual(result, [{'v': 1}])
+
+    def test_pool(self):
+        import tempfile, shutil, os
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = SqliteStore(
+                os.path.join(tmpdir, 'test.db'),
+                pragmas={'journal_mode': 'WAL', 'synchronous': 'NORMAL'},
+                max_connections=2
+            )
+            with cache.pool.connection() as db:
+                self.assertEqual(db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+                with cache.pool.connection() as db2:
+                    self.assertRaises(ConnectionPoolTimeout, cache.pool.checkout, 0.01)
+
+            cache.add({'v': 1})
+            self.assertEqual(cache.filter(), [{'v': 1}])
+            cache.close()
+            self.assertRaises(sqlite3.ProgrammingError, cache.filter)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_columns(self):
+        cache = SqliteStore(columns=['sid', 'level'])
+
+        msgs = [{'sid': 'a%d' % (i % 3), 'level': i, 'tags': [i]} for i in range(20)]
+        msgs.append({'sid': 'b'})
+        cache.add(*msgs)
+
+        conds = [
+            Q(sid='a1'),
+            Q(sid='a1', level__gt=10),
+            Q(sid__in=['a0', 'b']) | Q(level__lt=2),
+            ~Q(level__ge=3),
+            Q(sid='a2') & ~Q(level__in=[2, 5]),
+            Q(sid='a0', tags__ne=[0]),
+            ~(Q(sid='a1') | Q(tags=[2])),
+        ]
+        for cond in conds:
+            self.assertEqual(cache.filter(cond), filter(cond, msgs), cond)
+
+        sql, params, rest = (Q(sid='a0', tags__ne=[0]) | Q(level=1)).to_sql(cache.columns)
+        self.assertEqual(sql, None)
+        sql, params, rest = Q(sid='a0', tags__ne=[0]).to_sql(cache.columns)
+        self.assertEqual((sql, params, rest.children), ('("sid" = ?)', ['a0'], [('tags', 'ne', [0])]))
+
+        with cache.pool.connection() as db:
+            plan = db.execute('EXPLAIN QUERY PLAN SELECT value FROM litestore WHERE "sid" = ?', ('a0', )).fetchall()
+            self.assertTrue('litestore_sid' in str(plan))
+
+        self.assertEqual(cache.exclude(Q(sid='a1', level__le=4)), [msgs[1], msgs[4]])
+        self.assertEqual(len(cache.filter(Q(sid='a1'))), 5)
+
+    def test_columns_odd_values(self):
+        # None and non-scalars in a declared column are not confused with a missing field
+        cache = SqliteStore(columns=['a'])
+        msgs = [{'a': 0}, {'a': 1}, {'a': 'x'}, {'b': 1}]
+        cache.add(*msgs)
+        conds = [Q(a__ne=1), Q(a__lt=2), ~Q(a=1), Q(a=0) | Q(a__ge='x')]
+
+        for cond in conds:
+            self.assertEqual(cache.filter(cond), filter(cond, msgs), cond)
+            self.assertEqual(list(cache.iter_filter(cond, batch_size=2)), filter(cond, msgs), cond)
+
+        odd = [{'a': None}, {'a': [1]}]
+        cache.add(*odd)
+        msgs.extend(odd)
+        for cond in conds:
+            self.assertEqual(cache.filter(cond), filter(cond, msgs), cond)
+            self.assertEqual(list(cache.iter_filter(cond, batch_size=2)), filter(cond, msgs), cond)
+
+        reference = SimpleCache()
+        reference.add(*msgs)
+        self.assertEqual(cache.exclude(Q(a__lt=2)), reference.exclude(Q(a__lt=2)))
+        self.assertEqual(cache.filter(), reference.filter())
+
+        # values sqlite can not bind or compare as python does
+        cache = SqliteStore(columns=['a'])
+        msgs = [{'a': 'caf\xc3\xa9'}, {'a': 2 ** 62}, {'a': 5}]
+        cache.add(*msgs)
+        conds = [Q(a='caf\xc3\xa9'), Q(a__ne=5), Q(a__gt=2 ** 64), Q(a='\xff'), Q(a__in=['caf\xc3\xa9', 5])]
+        for odd in ([], [{'a': '\xff'}, {'a': 2 ** 70}, {'a': float('nan')}]):
+            cache.add(*odd)
+            msgs.extend(odd)
+            for cond in conds:
+                # repr, as nan != nan
+                self.assertEqual(repr(cache.filter(cond)), repr(filter(cond, msgs)), cond)
+
+    def test_exclude_decodes_once(self):
+        import json
+
+        loads = []
+
+        class CountedValue(object):
+            def __init__(self, d):
+                self.d = d
+
+            @staticmethod
+            def loads(raw):
+                loads.append(raw)
+                return CountedValue(json.loads(raw))
+
+            @staticmethod
+            def dumps(cv):
+                return json.dumps(cv.d)
+
+        cache = SqliteStore(value_type=CountedValue)
+        cache.add(*[CountedValue({'v': i}) for i in range(10)])
+
+        excluded = cache.exclude(lambda cv: cv.d['v'] % 2 == 0)
+        self.assertEqual([cv.d['v'] for cv in excluded], [0, 2, 4, 6, 8])
+        self.assertEqual(len(loads), 10)
+        self.assertEqual([cv.d['v'] for cv in cache.filter()], [1, 3, 5, 7, 9])
+
+    def test_iter(self):
+        cache = SqliteStore(columns=['k'])
+        msgs = [{'k': i % 4, 'v': i} for i in range(25)]
+        cache.add(*msgs)
+
+        self.assertEqual(list(cache.iter_filter(batch_size=7)), msgs)
+        self.assertEqual(
+            list(cache.iter_filter(Q(k=1) & Q(v__gt=10), batch_size=3)),
+            [msg for msg in msgs if msg['k'] == 1 and msg['v'] > 10]
+        )
+        self.assertEqual(
+            list(cache.iter_filter(Q(k=0) | Q(k=3), batch_size=2)),
+            [msg for msg in msgs if msg['k'] in (0, 3)]
+        )
+        self.assertEqual(
+            list(cache.iter_exclude(lambda msg: msg['v'] % 5 == 0, batch_size=4)),
+            msgs[::5]
+        )
+        self.assertEqual(list(cache.iter_exclude(Q(k=2), batch_size=2)), [
+            msg for msg in msgs if msg['k'] == 2 and msg['v'] % 5
+        ])
+        self.assertEqual(len(cache.filter()), 15)
+        self.assertEqual(
+            list(cache.iter_exclude(Q(k=0) | Q(k=3), batch_size=2)),
+            [msg for msg in msgs if msg['k'] in (0, 3) and msg['v'] % 5]
+        )
+        self.assertEqual(len(cache.filter()), 5)
+        self.assertEqual(len(list(cache.iter_exclude(batch_size=5))), 5)
+        self.assertEqual(cache.filter(), [])
+
+    def test_codecs(self):
+        import tempfile, shutil, os
+
+        msgs = [{'v': i, 'text': 'x' * (i * 500)} for i in range(5)]
+        for name in ('pickle', 'marshal', 'json'):
+            cache = SqliteStore(codec=name, compress='zlib', compress_threshold=1000)
+            cache.add(*msgs)
+            self.assertEqual(cache.filter(), msgs)
+
+            with cache.pool.connection() as db:
+                codec_ids = [row[0] for row in db.execute('SELECT codec FROM litestore ORDER BY id')]
+                types = set(row[0] for row in db.execute('SELECT typeof(value) FROM litestore'))
+            codec_id = codecs[name].id
+            zlib_id = compressors['zlib'].id << 8
+            self.assertEqual(codec_ids, [codec_id] * 2 + [codec_id | zlib_id] * 3)
+            self.assertEqual(types, set(['blob']))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'test.db')
+            SqliteStore(path, codec='json').add(*msgs[:2])
+            cache = SqliteStore(path, codec='pickle')
+            cache.add(*msgs[2:])
+            self.assertEqual(cache.filter(), msgs)
+            self.assertEqual(cache.reencode(batch_size=2), 2)
+            self.assertEqual(cache.reencode(), 0)
+            self.assertEqual(cache.filter(), msgs)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_legacy_rows(self):
+        # rows written before the codec column existed
+        import tempfile, shutil, os
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'test.db')
+            db = sqlite3.connect(path)
+            db.execute('''
+                CREATE TABLE litestore(
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    value SqliteStoreValue
+                )
+            ''')
+            db.execute('INSERT INTO litestore(value) VALUES(?)', (pickle.dumps({'v': 1}), ))
+            db.commit()
+            db.close()
+
+            cache = SqliteStore(path)
+            cache.add({'v': 2})
+            self.assertEqual(cache.filter(), [{'v': 1}, {'v': 2}])
+            self.assertEqual(cache.reencode(), 1)
+            self.assertEqual(cache.exclude(), [{'v': 1}, {'v': 2}])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_write_behind(self):
+        import time
+
+        cache = SqliteStore(write_behind=True, batch_size=10, flush_interval=0.2, max_pending=20)
+        cache.add(*[{'v': i} for i in range(5)])
+        self.assertEqual(len(cache._pending), 5)
+
+        # flushed by time
+        time.sleep(0.5)
+        self.assertEqual(len(cache._pending), 0)
+
+        # flushed by size, from the flusher thread
+        cache.add(*[{'v': i} for i in range(5, 15)])
+        time.sleep(0.1)
+        self.assertEqual(len(cache._pending), 0)
+
+        # other APIs see buffered values
+        cache.add({'v': 15})
+        self.assertEqual([msg['v'] for msg in cache.filter()], range(16))
+
+        cache.add({'v': 16})
+        cache.close()
+        self.assertEqual(len(cache._pending), 0)
+        # nothing would write it
+        self.assertRaises(sqlite3.ProgrammingError, cache.add, {'v': 17})
+        self.assertEqual(len(cache._pending), 0)
+
+    def test_parallel_reads(self):
+        import time, tempfile, shutil, os
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = SqliteStore(os.path.join(tmpdir, 'test.db'), write_behind=True)
+            cache.add(*[{'v': i} for i in range(3)])
+
+            state = {'active': 0, 'peak': 0}
+            lock = Lock()
+            def slow_cond(msg):
+                with lock:
+                    state['active'] += 1
+                    state['peak'] = max(state['peak'], state['active'])
+                time.sleep(0.05)
+                with lock:
+                    state['active'] -= 1
+                return True
+
+            results = []
+            threads = [make_thread(lambda: results.append(len(cache.filter(slow_cond)))) for _ in range(3)]
+            for t in threads:
+                t.join()
+            # every reader sees the buffered values
+            self.assertEqual(results, [3, 3, 3])
+            self.assertTrue(state['peak'] > 1)
+            cache.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_key_value(self):
+        cache = SqliteStore(columns=['v'])
+
+        cache.put('a', {'v': 1})
+        cache.put_many({'b': {'v': 2}, 3: {'v': 3}})
+        cache.add({'v': 4})
+        self.assertEqual(cache.get('a'), {'v': 1})
+        self.assertEqual(cache.get('z', 'default'), 'default')
+        self.assertTrue('b' in cache)
+        self.assertFalse(cache.contains('z'))
+
+        cache.put('a', {'v': 5})
+        self.assertEqual(cache.get('a'), {'v': 5})
+        cache.keys_per_query = 2
+        self.assertEqual(cache.get_many(['a', 'b', 3, 'z']), {'a': {'v': 5}, 'b': {'v': 2}, 3: {'v': 3}})
+
+        self.assertEqual(cache.filter(Q(v__gt=2)), [{'v': 3}, {'v': 4}, {'v': 5}])
+        self.assertTrue(cache.delete('a'))
+        self.assertFalse(cache.delete('a'))
+        self.assertEqual(cache.delete_many(['b', 3, 'z']), 2)
+        self.assertEqual(cache.filter(), [{'v': 4}])
+
+        # keys come back as they are passed
+        keys = ['caf\xc3\xa9', u'k\xe9y', 'k\xff', 2 ** 62]
+        cache.put_many((key, i) for i, key in enumerate(keys))
+        self.assertEqual(cache.get('k\xff'), 2)
+        self.assertEqual(cache.get(u'caf\xe9'), 0)
+        found = cache.get_many(keys + ['a'])
+        self.assertEqual(found, dict((key, i) for i, key in enumerate(keys)))
+        self.assertEqual(set(map(repr, found)), set(map(repr, keys)))
+        self.assertEqual(cache.delete_many(keys), 4)
+        self.assertRaises(AssertionError, cache.put, 2 ** 70, 1)
+
+    def test_ttl(self):
+        import time
+
+        cache = SqliteStore(ttl=0.2)
+        cache.add({'v': 1})
+        cache.add({'v': 2}, ttl=None)
+        cache.put('k', {'v': 3})
+        cache.put('l', {'v': 4}, ttl=10)
+        self.assertEqual(len(cache.filter()), 4)
+
+        time.sleep(0.3)
+        self.assertEqual(cache.filter(), [{'v': 2}, {'v': 4}])
+        self.assertFalse('k' in cache)
+
+        # the next expiry is known, nothing to delete before it
+        self.assertTrue(cache._next_expiry > time.time() + 9)
+        self.assertEqual(cache._expire(), 0)
+
+        with cache.pool.connection() as db:
+            plan = db.execute('EXPLAIN QUERY PLAN ' + cache._sql['expire'], (0, )).fetchall()
+        self.assertTrue('litestore_expires_at' in str(plan))
+
+    def test_stats(self):
+        reports = []
+        cache = SqliteStore(columns=['v'], stats=CacheStats(callback=reports.append, interval=0))
+        cache.add(*[{'v': i} for i in range(10)])
+        self.assertEqual(len(cache.filter(Q(v__lt=3))), 3)
+        self.assertEqual(len(cache.filter(lambda msg: msg['v'] < 3)), 3)
+        self.assertEqual(len(cache.exclude(Q(v__ge=8))), 2)
+
+        snapshot = cache.stats.snapshot()
+        self.assertEqual(snapshot['counters']['rows_scanned'], 3 + 10 + 2)
+        self.assertEqual(snapshot['counters']['rows_returned'], 3 + 3 + 2)
+        self.assertTrue(snapshot['counters']['bytes_encoded'] > 0)
+        self.assertEqual(snapshot['latencies']['filter']['count'], 2)
+        self.assertEqual(snapshot['latencies']['lock_wait']['count'], 4)
+        self.assertEqual(snapshot['gauges'], {'pending': 0})
+        self.assertTrue(reports)
+
+        self.assertEqual(cache.stats.reset()['latencies']['exclude']['count'], 1)
+        self.assertEqual(cache.stats.snapshot()['counters'], {})
+
+        # latencies are named by public APIs, whatever they call
+        cache.put('k', 1)
+        cache.delete('k')
+        list(cache.iter_filter(batch_size=5))
+        list(cache.iter_exclude(Q(v=0), batch_size=5))
+        buffered = SqliteStore(write_behind=True, stats=cache.stats)
+        buffered.add({'v': 1})
+        latencies = cache.stats.snapshot()['latencies']
+        self.assertEqual(
+            sorted(name for name in latencies if name not in ('lock_wait', 'maintain')),
+            ['add', 'delete', 'iter_exclude', 'iter_filter', 'put']
+        )
+        self.assertEqual(latencies['iter_filter']['count'], 2)
+        self.assertEqual(latencies['lock_wait']['count'], 5)
+        buffered.close()
+
+        # the callback runs out of the lock, so it may use the store
+        sizes = []
+        cache = SqliteStore(stats=CacheStats(callback=lambda snapshot: sizes.append(len(cache.filter())),
+                                             interval=0))
+        adding = make_thread(cache.add, args=({'v': 1}, ), daemon=True)
+        adding.join(5)
+        self.assertFalse(adding.is_alive())
+        self.assertEqual(sizes, [1])
+
     def test_custom_type_auto_outdate(self):
         import json
         import time
@@ -553,6 +4082,722 @@ class TestSqliteStore(unittest.TestCase):
 
 
 
+class TestSqliteQueue(unittest.TestCase):
+    def test_basic(self):
+        import time
+
+        store = SqliteStore()
+        queue = SqliteQueue(store)
+        queue.put_many([{'job': i} for i in range(5)])
+        queue.put({'job': 5})
+        self.assertEqual(len(queue), 6)
+        # the store's own table is not touched
+        self.assertEqual(store.filter(), [])
+
+        first = queue.get(batch=2, visibility_timeout=0.1)
+        self.assertEqual([value['job'] for _, value in first], [0, 1])
+        second = queue.get(batch=2)
+        self.assertEqual([value['job'] for _, value in second], [2, 3])
+
+        self.assertEqual(queue.ack([second[0][0]]), 1)
+        queue.nack([second[1][0]])
+        # 3 is back, leases of 0 and 1 are not over yet
+        self.assertEqual([value['job'] for _, value in queue.get(batch=3)], [3, 4, 5])
+        self.assertEqual(queue.get(), [])
+
+        time.sleep(0.15)
+        again = queue.get(batch=5)
+        self.assertEqual([value['job'] for _, value in again], [0, 1])
+        queue.ack(msg_id for msg_id, _ in again)
+        self.assertEqual(len(queue), 3)
+
+    def test_index(self):
+        queue = SqliteQueue(name='jobs')
+        with queue.store.pool.connection() as db:
+            for name in ('ready', 'release'):
+                params = (0, 1) if name == 'release' else (1, )
+                plan = str(db.execute('EXPLAIN QUERY PLAN ' + queue._sql[name], params).fetchall())
+                self.assertTrue('jobs_lease' in plan, plan)
+                self.assertFalse('TEMP B-TREE' in plan, plan)
+
+
+class TestShardedSqliteStore(unittest.TestCase):
+    def test_basic(self):
+        store = ShardedSqliteStore([':memory:'] * 3, columns=['v'])
+        store.add(*[{'v': i} for i in range(10)])
+        store.add({'v': 10}, ttl=60)
+        self.assertEqual([len(shard.filter()) for shard in store.shards], [4, 4, 3])
+        self.assertEqual(sorted(msg['v'] for msg in store.filter(Q(v__lt=5))), range(5))
+        self.assertEqual(sorted(msg['v'] for msg in store.iter_filter(batch_size=2)), range(11))
+
+        excluded = store.exclude(lambda msg: msg['v'] % 2)
+        self.assertEqual(sorted(msg['v'] for msg in excluded), [1, 3, 5, 7, 9])
+        self.assertEqual(len(store.filter()), 6)
+        excluded = store.iter_exclude(Q(v__ge=8), batch_size=1)
+        self.assertEqual(sorted(msg['v'] for msg in excluded), [8, 10])
+        self.assertEqual(len(store.filter()), 4)
+        self.assertEqual(store.get_cols(), store.shards[0].get_cols())
+        self.assertTrue('v' in store.get_cols())
+        self.assertEqual(store.reencode(), 0)
+        store.maintain()
+        store.exclude()
+
+        store.put_many(('key-%d' % i, i) for i in range(20))
+        store.put(u'k\xe9y', 'unicode')
+        self.assertEqual(store.get(u'k\xe9y'), 'unicode')
+        self.assertTrue(all(len(shard.filter()) > 0 for shard in store.shards))
+        self.assertEqual(store.get_many(['key-3', 'key-4', 'none']), {'key-3': 3, 'key-4': 4})
+        self.assertEqual(store.get('key-5'), 5)
+        self.assertTrue('key-6' in store)
+        self.assertEqual(store.delete_many(['key-1', 'key-2', 'none']), 2)
+        self.assertTrue(store.delete('key-3'))
+        self.assertEqual(len(store.filter()), 18)
+        # keys are found by the same shard
+        self.assertEqual(store._shard_of('key-7'), zlib.crc32('key-7') % 3)
+        store.close()
+
+
+class TestSharedStore(unittest.TestCase):
+    def test_processes(self):
+        store = SharedStore('test-%d' % os.getpid(), ttl=60)
+        try:
+            store.put('warm', {'v': 0})
+
+            children = []
+            for i in range(3):
+                pid = os.fork()
+                if pid == 0:
+                    # child: see the parent's data, and write its own
+                    code = 1
+                    try:
+                        if store.get('warm') == {'v': 0}:
+                            store.add({'v': i + 1})
+                            store.put('child-%d' % i, i)
+                            code = 0
+                    finally:
+                        os._exit(code)
+                children.append(pid)
+
+            for pid in children:
+                self.assertEqual(os.waitpid(pid, 0)[1], 0)
+
+            # filter() sees keyed values too
+            self.assertEqual(sorted(msg['v'] for msg in store.filter() if isinstance(msg, dict)), [0, 1, 2, 3])
+            self.assertEqual(store.get_many(['child-%d' % i for i in range(3)]),
+                             {'child-0': 0, 'child-1': 1, 'child-2': 2})
+
+            other = SharedStore('test-%d' % os.getpid())
+            self.assertEqual(other.get('child-1'), 1)
+            with other.pool.connection() as db:
+                self.assertEqual(db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            other.close()
+        finally:
+            store.destroy()
+        self.assertFalse(os.path.exists(store.dbpath))
+
+    def test_write_behind(self):
+        store = SharedStore('test-%d' % os.getpid(), write_behind=True, flush_interval=0.5)
+        try:
+            store.add({'v': 0})
+            pid = os.fork()
+            if pid == 0:
+                # child: its values are flushed by its own flusher
+                code = 1
+                try:
+                    store.add({'v': 1})
+                    deadline = time() + 5
+                    while store._pending and time() < deadline:
+                        sleep(0.01)
+                    if not store._pending:
+                        code = 0
+                finally:
+                    os._exit(code)
+
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            store.flush()
+            # the parent's buffered value is written once
+            self.assertEqual(sorted(msg['v'] for msg in store.filter()), [0, 1])
+        finally:
+            store.destroy()
+
+    def test_locks_held_at_fork(self):
+        import signal
+
+        store = SharedStore('test-%d' % os.getpid(), write_behind=True, flush_interval=0.05)
+        try:
+            store.put('k', 0)
+            # as if threads of the parent hold them when it forks
+            locks = [store._thread_lock_.writer, store._maintain_lock, store._pending_cond, store.pool._cond]
+            for lock in locks:
+                lock.acquire()
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    signal.alarm(5)
+                    store.add({'v': 1})
+                    store.put('k', 1)
+                    store.flush()
+                    if store.get('k') == 1 and {'v': 1} in store.filter():
+                        code = 0
+                finally:
+                    os._exit(code)
+
+            for lock in reversed(locks):
+                lock.release()
+            self.assertEqual(os.waitpid(pid, 0)[1], 0)
+            self.assertEqual(store.get('k'), 1)
+        finally:
+            store.destroy()
+
+
+class TestAsyncFacade(unittest.TestCase):
+    def test_simple_cache(self):
+        cache = AsyncSimpleCache(SimpleCache(indexes={'v': lambda msg: msg['v']}), readers=2)
+        futures = [cache.add({'v': i}) for i in range(10)]
+        self.assertEqual([f.result(timeout=5) for f in futures], [None] * 10)
+        self.assertEqual(cache.get_by('v', 3).result(timeout=5), [{'v': 3}])
+        self.assertEqual(len(cache.exclude(Q(v__lt=5)).result(timeout=5)), 5)
+        self.assertEqual(len(cache.filter().result(timeout=5)), 5)
+
+        # exceptions are raised by result()
+        self.assertRaises(KeyError, cache.get_by('no_index', 1).result, 5)
+        cache.close()
+
+    def test_sqlite_store(self):
+        store = AsyncSqliteStore(SqliteStore())
+        store.add(*[{'v': i} for i in range(25)])
+        store.put('k', {'v': 100})
+        # writes are in order, the put is done once the flush is
+        self.assertTrue(store.flush().result(timeout=5) is None)
+        self.assertEqual(store.get('k').result(timeout=5), {'v': 100})
+
+        batches = list(store.iter_filter(Q(v__lt=20), batch_size=8))
+        self.assertEqual([len(b) for b in batches], [8, 8, 4])
+        self.assertEqual([msg['v'] for b in batches for msg in b], range(20))
+
+        batches = list(store.iter_exclude(Q(v__ge=10), batch_size=8))
+        self.assertEqual(sum(len(b) for b in batches), 16)
+        self.assertEqual(len(store.filter().result(timeout=5)), 10)
+
+        # only batches handed to the caller are deleted
+        for batch in store.iter_exclude(batch_size=2):
+            self.assertEqual(len(batch), 2)
+            break
+        sleep(0.05)
+        self.assertEqual(len(store.filter().result(timeout=5)), 8)
+
+        # with a python condition, a batch is a whole store batch, even when short
+        for batch in store.iter_exclude(lambda msg: msg['v'] % 2 == 0, batch_size=4):
+            self.assertEqual([msg['v'] for msg in batch], [2, 4])
+            break
+        sleep(0.05)
+        self.assertEqual([msg['v'] for msg in store.filter().result(timeout=5)], [3, 5, 6, 7, 8, 9])
+        store.close()
+
+
+class TestMemoize(unittest.TestCase):
+    def test_basic(self):
+        calls = []
+
+        @memoize(max_items=2)
+        def double(x, factor=2):
+            calls.append(x)
+            return x * factor
+
+        self.assertEqual([double(1), double(1), double(2), double(1, factor=3)], [2, 2, 4, 3])
+        self.assertEqual(calls, [1, 2, 1])
+        # unhashable arguments
+        self.assertEqual(double([1]), [1, 1])
+        self.assertEqual(double([1]), [1, 1])
+        self.assertEqual(double.__name__, 'double')
+
+        stats = double.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['size']), (2, 4, 2, 2))
+        double.clear()
+        self.assertEqual(double.stats()['size'], 0)
+
+    def test_ttl_and_method(self):
+        import time
+
+        class Counter(object):
+            def __init__(self):
+                self.n = 0
+
+            @memoize(ttl=0.1)
+            def next(self):
+                self.n += 1
+                return self.n
+
+        counter = Counter()
+        self.assertEqual([counter.next(), counter.next()], [1, 1])
+        self.assertEqual(Counter().next(), 1)
+        time.sleep(0.15)
+        self.assertEqual(counter.next(), 2)
+
+    def test_single_call_per_key(self):
+        import time
+        calls = []
+
+        @memoize()
+        def slow(x):
+            calls.append(x)
+            time.sleep(0.2)
+            if x < 0:
+                raise ValueError(x)
+            return x
+
+        results = []
+        def call(x):
+            try:
+                results.append(slow(x))
+            except ValueError:
+                results.append('error')
+
+        threads = [make_thread(call, args=(i % 2 - 1, )) for i in range(8)]
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(calls), [-1, 0])
+        self.assertEqual(sorted(results), [0] * 4 + ['error'] * 4)
+        self.assertEqual(slow.stats()['waits'], 6)
+
+    def test_store(self):
+        store = SqliteStore()
+        calls = []
+
+        def square(x):
+            calls.append(x)
+            return x * x
+
+        self.assertEqual(memoize(store=store)(square)(3), 9)
+        # a new process, results are read from the store
+        cached = memoize(store=store)(square)
+        self.assertEqual(cached(3), 9)
+        self.assertEqual(calls, [3])
+        self.assertEqual(cached.stats()['store_hits'], 1)
+
+        # unhashable arguments are stored by a stable repr, not by the pickle
+        self.assertEqual(memoize(store=store)(len)({'a': 1, 'b': 2}), 2)
+        self.assertEqual(memoize(store=store)(len)({'b': 2, 'a': 1}), 2)
+        self.assertTrue(store.contains("__builtin__.len:({'a': 1, 'b': 2},)"))
+
+        # methods need a key without self, whose repr has its address
+        class Account(object):
+            def __init__(self, name):
+                self.name = name
+
+            @memoize(store=store)
+            def balance(self, day):
+                return day
+
+            @memoize(store=store, key=lambda args, kwargs: (args[0].name, ) + args[1:])
+            def total(self, day):
+                calls.append(day)
+                return day * 2
+
+        self.assertRaises(AssertionError, Account('a').balance, 1)
+        self.assertEqual(Account('a').total(2), 4)
+        Account.total.clear()
+        # a new object of the same name, e.g. after a restart
+        self.assertEqual(Account('a').total(2), 4)
+        self.assertEqual(calls, [3, 2])
+
+
+class TestTieredCache(unittest.TestCase):
+    def test_write_through(self):
+        cache = TieredCache(max_items=2)
+        for i in range(4):
+            cache.put(i, {'v': i})
+        self.assertEqual(len(cache.memory.filter()), 2)
+        self.assertEqual(cache.store.get_many(range(4)), dict((i, {'v': i}) for i in range(4)))
+
+        # 0 is promoted from store, 2 is evicted
+        self.assertEqual(cache.get(0), {'v': 0})
+        self.assertEqual(cache.get(0), {'v': 0})
+        self.assertEqual([key for key, _ in cache.memory.filter()], [3, 0])
+        self.assertEqual((cache.hits, cache.store_hits, cache.misses), (1, 1, 0))
+
+        self.assertEqual(cache.get(5, 'none'), 'none')
+        self.assertEqual(cache.misses, 1)
+        self.assertTrue(cache.delete(0))
+        self.assertFalse(0 in cache)
+        self.assertTrue(1 in cache)
+
+    def test_write_behind(self):
+        import tempfile, shutil, os
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'test.db')
+            cache = TieredCache(SqliteStore(path), max_items=2, write='behind')
+            for i in range(4):
+                cache.put(i, {'v': i})
+
+            # evicted values are spilled, the others are in memory only
+            self.assertEqual(sorted(cache.store.get_many(range(4))), [0, 1])
+            self.assertEqual(cache.get_many(range(4)), dict((i, {'v': i}) for i in range(4)))
+            cache.put(1, {'v': 10})
+            cache.close()
+
+            cache = TieredCache(SqliteStore(path), max_items=2)
+            self.assertEqual(cache.get_many(range(4)), dict((i, {'v': 10 if i == 1 else i}) for i in range(4)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_loader(self):
+        loaded = []
+        def loader(key):
+            loaded.append(key)
+            return key * 2
+
+        cache = TieredCache(max_items=10, loader=loader)
+        self.assertEqual(cache.get(3), 6)
+        self.assertEqual(cache.get(3), 6)
+        self.assertEqual(cache.get_many([3, 4]), {3: 6, 4: 8})
+        self.assertEqual(loaded, [3, 4])
+        self.assertEqual(cache.store.get(4), 8)
+
+    def test_cold_read_unlocked(self):
+        from threading import Event
+
+        gate = Event()
+        reading = Event()
+
+        class SlowStore(SqliteStore):
+            def get_many(self, keys):
+                found = SqliteStore.get_many(self, keys)
+                reading.set()
+                gate.wait(5)
+                return found
+
+        cache = TieredCache(SlowStore(), max_items=2)
+        cache.put('hot', 1)
+        cache.store.put('cold', 1)
+        cold = make_thread(cache.get, args=('cold', ))
+        reading.wait(5)
+        # a hot read and a write are not blocked by the cold read
+        self.assertEqual(cache.get('hot'), 1)
+        cache.put('cold', 2)
+        gate.set()
+        cold.join(5)
+        self.assertEqual(cold.result(), 1)
+        # the value read before the put is not promoted over it
+        self.assertEqual(cache.memory.get_by('key', 'cold'), [('cold', 2)])
+
+
+class TestSimpleCache(unittest.TestCase):
+    def test_basic(self):
+        cache = SimpleCache()
+
+        msgs = [{'v': 1}, {'v':2}, {'v': 3}]
+        cache.add(*msgs)
+
+        self.assertEqual(cache.filter(), msgs)
+        self.assertEqual(cache[1], msgs[1])
+        self.assertEqual(list(cache), msgs)
+
+        fmsgs = cache.exclude(lambda msg: msg['v'] == 2)
+        self.assertEqual(fmsgs, [msgs[1]])
+        self.assertEqual(cache.exclude(), [msgs[0], msgs[2]])
+        self.assertEqual(len(cache.filter()), 0)
+
+    def test_index(self):
+        cache = SimpleCache(indexes={'sid': lambda msg: msg['sid']})
+
+        msgs = [{'sid': i % 3, 'v': i} for i in range(9)]
+        cache.add(*msgs)
+
+        self.assertEqual(cache.get_by('sid', 1), [msgs[1], msgs[4], msgs[7]])
+        self.assertEqual(cache.get_by('sid', 5), [])
+
+        fmsgs = cache.exclude_by('sid', 2)
+        self.assertEqual(fmsgs, [msgs[2], msgs[5], msgs[8]])
+        self.assertEqual(cache.get_by('sid', 2), [])
+
+        # index stays in sync with exclude
+        cache.exclude(lambda msg: msg['v'] == 4)
+        self.assertEqual(cache.get_by('sid', 1), [msgs[1], msgs[7]])
+        self.assertEqual(cache.filter(), [msgs[0], msgs[1], msgs[3], msgs[6], msgs[7]])
+
+        cache.exclude()
+        self.assertEqual(cache.get_by('sid', 0), [])
+
+    def test_ttl(self):
+        import time
+
+        cache = SimpleCache(ttl=0.5, indexes={'v': lambda msg: msg['v']})
+        cache.add({'v': 1}, {'v': 2})
+        cache.add({'v': 3}, ttl=None)
+        cache.add({'v': 4}, ttl=5)
+        self.assertEqual(len(cache.filter()), 4)
+
+        time.sleep(0.6)
+        self.assertEqual(cache.filter(), [{'v': 3}, {'v': 4}])
+        self.assertEqual(cache.get_by('v', 1), [])
+
+        # excluded records leave stale heap entries behind, which are skipped
+        cache.add({'v': 5}, ttl=0.1)
+        cache.exclude_by('v', 5)
+        time.sleep(0.2)
+        self.assertEqual(cache.filter(), [{'v': 3}, {'v': 4}])
+
+    def test_max_items(self):
+        evicted = []
+        cache = SimpleCache(max_items=3, indexes={'v': lambda msg: msg['v']}, on_evict=evicted.append)
+        cache.add({'v': 1}, {'v': 2}, {'v': 3})
+        cache.get_by('v', 1)
+        cache.add({'v': 4})
+
+        # lru: 2 is the least recently used
+        self.assertEqual(cache.filter(), [{'v': 1}, {'v': 3}, {'v': 4}])
+        self.assertEqual(evicted, [{'v': 2}])
+        self.assertEqual(cache.get_by('v', 2), [])
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 1, 1))
+
+    def test_max_bytes(self):
+        cache = SimpleCache(max_bytes=10, policy='fifo', sizeof=len)
+        cache.add('abc', 'defg', 'hij')
+        self.assertEqual(cache.bytes, 10)
+        cache.add('kl')
+        self.assertEqual(cache.filter(), ['defg', 'hij', 'kl'])
+        self.assertEqual(cache.bytes, 9)
+        cache.exclude()
+        self.assertEqual(cache.bytes, 0)
+
+    def test_policies(self):
+        for name in ('fifo', 'lru', 'lfu', 'arc'):
+            cache = SimpleCache(max_items=10, policy=name, indexes={'v': lambda v: v}, policy_key='v')
+            for i in range(100):
+                cache.add(i)
+                cache.get_by('v', i % 7)
+            self.assertEqual(len(cache.filter()), 10)
+            self.assertEqual(cache.evictions, 90)
+
+        lfu = LFUPolicy()
+        for token in 'abc':
+            lfu.add(token)
+        lfu.touch('a')
+        lfu.touch('c')
+        self.assertEqual(lfu.victim(), 'b')
+        lfu.discard('a')
+        self.assertEqual(lfu.victim(), 'c')
+        # 'c' goes on from its frequency
+        for token in 'cde':
+            lfu.add(token)
+        self.assertEqual(lfu.freqs['c'], 3)
+        self.assertEqual([lfu.victim(), lfu.victim()], ['d', 'e'])
+
+        arc = ARCPolicy()
+        for token in 'abc':
+            arc.add(token)
+        arc.touch('a')
+        self.assertEqual(arc.victim(), 'b')
+        arc.add('b')     # ghost hit
+        self.assertTrue('b' in arc.t2)
+
+    def test_policy_key(self):
+        self.assertRaises(AssertionError, SimpleCache, max_items=2, policy='arc')
+
+        # ghosts of keys hit when records are added again
+        cache = SimpleCache(max_items=2, policy='arc', indexes={'k': operator.itemgetter(0)}, policy_key='k')
+        cache.add(('a', 1), ('b', 1), ('c', 1))
+        self.assertEqual(cache.evictions, 1)
+        self.assertTrue('a' in cache._policy.b1)
+        cache.add(('a', 2))
+        self.assertTrue(cache._policy.p > 0)
+        self.assertEqual(cache.get_by('k', 'a'), [('a', 2)])
+        # indexes are emptied, not replaced
+        cache.exclude()
+        cache.add(('a', 3), ('b', 1), ('c', 1))
+        self.assertEqual(cache.filter(), [('b', 1), ('c', 1)])
+
+        # records of a key are evicted together
+        cache = SimpleCache(max_items=3, policy='lru', indexes={'k': operator.itemgetter(0)}, policy_key='k')
+        cache.add(('a', 1), ('b', 1), ('a', 2))
+        cache.get_by('k', 'b')
+        cache.add(('c', 1), ('d', 1))
+        self.assertEqual(cache.filter(), [('b', 1), ('c', 1), ('d', 1)])
+        self.assertEqual(cache.evictions, 2)
+
+        # frequencies of keys survive updates
+        tiered = TieredCache(max_items=2, policy='lfu')
+        tiered.put(0, 'a')
+        for i in range(3):
+            tiered.get(0)
+        tiered.put(0, 'b')
+        tiered.put(1, 'a')
+        tiered.put(2, 'a')
+        self.assertEqual(tiered.memory.filter(), [(0, 'b'), (2, 'a')])
+
+    def test_rw_concurrency(self):
+        from threading import Thread
+
+        cache = SimpleCache(
+            ttl=0.05, concurrency='rw', max_items=50,
+            indexes={'v': lambda msg: msg['v'] % 10}
+        )
+        errors = []
+
+        def reader():
+            try:
+                for i in range(200):
+                    for msg in cache.get_by('v', i % 10):
+                        assert msg['v'] % 10 == i % 10
+                    cache.filter(lambda msg: msg['v'] > 10)
+                    list(cache)
+            except Exception as e:
+                errors.append(e)
+
+        def writer():
+            try:
+                for i in range(200):
+                    cache.add({'v': i})
+                    if i % 20 == 0:
+                        cache.exclude_by('v', 3)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=reader) for i in range(4)] + [Thread(target=writer) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(len(cache.filter()) <= 50)
+
+    def test_positions(self):
+        import random
+
+        rand = random.Random(5)
+        cache = SimpleCache(max_items=50, policy='fifo')
+        expected = []
+        for i in range(2000):
+            if rand.random() < 0.7:
+                cache.add(i)
+                expected = (expected + [i])[-50:]
+            else:
+                odd = rand.random() < 0.5
+                cache.exclude(lambda v: v % 7 == 0 if odd else v % 5 == 1)
+                expected = [v for v in expected if not (v % 7 == 0 if odd else v % 5 == 1)]
+            if expected:
+                self.assertEqual(cache[-1], expected[-1])
+                self.assertEqual(cache[0], expected[0])
+            self.assertEqual(cache[-5:], expected[-5:])
+            self.assertEqual(cache[::3], expected[::3])
+            self.assertEqual(list(cache), expected)
+        self.assertRaises(IndexError, cache.__getitem__, len(expected))
+        self.assertRaises(IndexError, cache.__getitem__, -len(expected) - 1)
+
+    def test_snapshot(self):
+        cache = SimpleCache()
+        cache.add(1, 2, 3)
+
+        snapshot = cache.snapshot()
+        self.assertEqual(snapshot, (1, 2, 3))
+        self.assertTrue(cache.snapshot() is snapshot)
+        self.assertEqual(cache[1:], [2, 3])
+
+        it = iter(cache)
+        cache.exclude(lambda v: v == 2)
+        cache.add(4)
+        self.assertEqual(list(it), [1, 2, 3])
+        self.assertEqual(snapshot, (1, 2, 3))
+        self.assertEqual(cache.snapshot(), (1, 3, 4))
+        self.assertTrue(cache.snapshot().version > snapshot.version)
+        self.assertEqual(cache.snapshot().version, cache.version)
+
+        # the same without a snapshot built before
+        cache = SimpleCache()
+        cache.add(1, 2, 3)
+        it = iter(cache)
+        next(it)
+        cache.exclude()
+        cache.add(4)
+        self.assertEqual(list(it), [2, 3])
+
+    def test_query(self):
+        msgs = [{'v': i, 'kind': 'odd' if i % 2 else 'even'} for i in range(10)]
+        msgs.append({'kind': 'none'})
+
+        cond = Q(v__ge=3, kind='odd') | Q(v__in=[0, 2])
+        self.assertTrue(cond(msgs[3]))
+        self.assertFalse(cond(msgs[4]))
+        self.assertFalse(cond(msgs[-1]))
+        self.assertFalse((~cond)(msgs[3]))
+
+        # vectorized and per-record evaluation agree
+        default_min = Q.vectorize_min
+        for vectorize_min in (0, 1000):
+            Q.vectorize_min = vectorize_min
+            try:
+                cache = SimpleCache()
+                cache.add(*msgs)
+                self.assertEqual(cache.filter(cond), [msgs[i] for i in (0, 2, 3, 5, 7, 9)])
+                self.assertEqual(cache.filter(~Q(v__lt=8)), [msgs[8], msgs[9], msgs[10]])
+                self.assertEqual(cache.filter(Q(kind__ne='odd', v__gt=5)), [msgs[6], msgs[8]])
+                self.assertEqual(cache.exclude(Q(kind='even') & ~Q(v=0)), [msgs[i] for i in (2, 4, 6, 8)])
+                self.assertEqual(len(cache.filter()), 7)
+
+                # unhashable values are not in a set of hashable ones
+                cache.add({'v': [1]})
+                self.assertEqual(cache.filter(Q(v__in=[1, 2])), [msgs[1]])
+                self.assertEqual(cache.filter(Q(v__in=[[1], 2])), [{'v': [1]}])
+            finally:
+                Q.vectorize_min = default_min
+
+    def test_stats(self):
+        cache = SimpleCache(max_items=5, indexes={'v': lambda msg: msg['v']},
+                            concurrency='rw', stats=True)
+        cache.add(*[{'v': i} for i in range(8)])
+        cache.get_by('v', 7)
+        self.assertEqual(len(cache.filter(Q(v__lt=5))), 2)
+
+        snapshot = cache.stats.snapshot()
+        self.assertEqual(snapshot['gauges'], {'records': 5, 'bytes': 0, 'hits': 1, 'misses': 0, 'evictions': 3})
+        self.assertEqual(snapshot['counters'], {'rows_scanned': 5, 'rows_returned': 2})
+        latencies = snapshot['latencies']
+        self.assertEqual((latencies['add']['count'], latencies['get_by']['count']), (1, 1))
+        self.assertEqual(latencies['lock_wait']['count'], 3)
+        self.assertEqual(latencies['maintain']['count'], 1)
+        self.assertEqual(sum(latencies['add']['buckets']), 1)
+
+        # the callback runs out of the lock, so it may use the cache
+        sizes = []
+        cache = SimpleCache(stats=CacheStats(callback=lambda snapshot: sizes.append(len(cache.filter())),
+                                             interval=0))
+        adding = make_thread(cache.add, args=({'v': 1}, ), daemon=True)
+        adding.join(5)
+        self.assertFalse(adding.is_alive())
+        self.assertEqual(sizes, [1])
+
+    def test_background(self):
+        import time
+
+        maintainer = Maintainer(interval=0.05)
+        cache = SimpleCache(
+            outdate_cond=lambda msg: msg['v'] % 2 == 0,
+            ttl=0.1,
+            background=maintainer
+        )
+        cache.slice_size = 16
+        cache.add(*[{'v': i} for i in range(100)])
+        cache.add({'v': 101}, ttl=None)
+
+        time.sleep(0.5)
+        self.assertEqual(cache.filter(), [{'v': 101}])
+        maintainer.unregister(cache)
+
+    def test_index_outdate(self):
+        cache = SimpleCache(
+            outdate_cond=lambda msg: msg['v'] < 2,
+            indexes={'sid': lambda msg: msg['sid']}
+        )
+        cache.add({'sid': 'a', 'v': 1}, {'sid': 'a', 'v': 2})
+        self.assertEqual(cache.get_by('sid', 'a'), [{'sid': 'a', 'v': 2}])
+
+
+
 def test_SqliteStore_threadsafe():
     from . import thread_util
     import json, time, random
@@ -1,6 +1,8 @@
 # -*- coding:utf-8 -*-
 
-import threading, thread, time
+import threading, thread, time, sys
+from functools import wraps
+import Queue
 
 
 nothing = object()
@@ -12,6 +14,11 @@ def threaded(**options):
             name -> default : decorated function name
             daemon -> default : False
             start -> default : True
+            pool -> a ThreadPool, run func in the pool instead of a new thread,
+                    a Future is returned, which can be joined like a thread.
+                    name, daemon and start are ignored.
+        the returned thread has `future`, done when func returns,
+        and `result(timeout)` of it, see wait_all.
         Example:
             @threaded(name='test_function', start=False, daemon=True)
             def test():
@@ -25,17 +32,32 @@ def threaded(**options):
         name = options.get('name', func.__name__)
         daemon = bool(options.get('daemon', False))
         start = bool(options.get('start', True))
+        pool = options.get('pool')
 
         assert callable(func)
 
+        if pool is not None:
+            def submit(*args, **kwargs):
+                return pool.submit(func, *args, **kwargs)
+            return submit
+
         def thread_gen(*args, **kwargs):
+            future = Future()
+
+            def target(*args, **kwargs):
+                future.run(func, *args, **kwargs)
+                if future._exc_info is not None:
+                    # printed by threading, as if func raised it
+                    raise future._exc_info[0], future._exc_info[1], future._exc_info[2]
 
             t = threading.Thread(
-                target=func, 
+                target=target, 
                 name=name,
                 args=args, 
                 kwargs=kwargs
             )
+            t.future = future
+            t.result = future.result
             t.setDaemon(daemon)
             if start:
                 t.start()
@@ -55,6 +77,7 @@ def make_thread(target, **options):
             name -> default : decorated function name
             daemon -> default : False
             start -> default : True
+            pool -> see threaded
     """
 
     args = options.pop('args', ())
@@ -62,19 +85,83 @@ def make_thread(target, **options):
     return threaded(**options)(target)(*args, **kwargs)
 
 
-def wait_threads(tasks, timeout=5):
+def _future_of(task):
+    """
+        Future done when task is done.
+        input:
+            task -> a Future, or a thread (started by threaded or not),
+                    a thread which is not started is done, as it's not alive.
+    """
+    if isinstance(task, Future):
+        return task
+    if task.ident is None:
+        future = Future()
+        future.set_result(None)
+        return future
+    future = getattr(task, 'future', None)
+    if future is None:
+        # other threads can only be joined
+        future = Future()
+        make_thread(lambda: (task.join(), future.set_result(None)), daemon=True)
+    return future
+
+
+def as_completed(tasks, timeout=None):
+    """
+        generator of tasks (threads or futures) in the order they are done,
+        each one is yielded as soon as it's done.
+        FutureTimeout is raised if they are not all done in `timeout` seconds.
+        Example:
+            threads = [make_thread(download, args=(url, )) for url in urls]
+            for t in as_completed(threads, timeout=10):
+                print t.result()
+    """
+    tasks = list(tasks)
+    deadline = None if timeout is None else time.time() + timeout
+    done = Queue.Queue()
+    for task in tasks:
+        _future_of(task).add_done_callback(lambda future, task=task: done.put(task))
+
+    for _ in tasks:
+        if deadline is None:
+            yield done.get()
+            continue
+        try:
+            yield done.get(True, max(deadline - time.time(), 0))
+        except Queue.Empty:
+            raise FutureTimeout('not done in %s seconds' % timeout)
+
+
+def wait_all(tasks, timeout=None):
     """
         output:
-            bool -> if all tasks are finished.
+            bool -> if all tasks are done in `timeout` seconds.
     """
-    deadline = time.time() + timeout
-    while time.time() < deadline:
-        if len(filter(lambda t: t.is_alive(), tasks)) == 0:
-            return True
+    try:
+        for _ in as_completed(tasks, timeout):
+            pass
+    except FutureTimeout:
+        return False
+    return True
 
-        time.sleep(0.2)
 
-    return False
+def wait_any(tasks, timeout=None):
+    """
+        output:
+            the first done task, or None if none is done in `timeout` seconds.
+    """
+    try:
+        return next(as_completed(tasks, timeout))
+    except (FutureTimeout, StopIteration):
+        return None
+
+
+def wait_threads(tasks, timeout=5):
+    """
+        output:
+            bool -> if all tasks are finished.
+    """
+    return wait_all(tasks, timeout)
 
 
 # thread safe decorator for function
@@ -98,10 +185,49 @@ def thread_safe(func):
 #     return new_method
 
 
+class LockTimeout(Exception):
+    pass
+
+
+_RLockType = type(threading.RLock())
+
+# guards lazy creation of locks by mthread_safe
+_creation_lock = threading.Lock()
+
+
+def _acquire(lock, timeout):
+    """
+        acquire a threading.Lock (or RLock) in `timeout` seconds,
+        which have no timeout in python 2.
+        output:
+            bool -> if acquired
+    """
+    if timeout is None:
+        return lock.acquire()
+
+    deadline = time.time() + timeout
+    delay = 0.0005
+    while not lock.acquire(False):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.05)
+    return True
+
+
 def mthread_safe(**options):
     """
         options:
             lock_name  -- the attribute name of thread lock
+            mode -- None: a threading.Lock
+                    'read' or 'write': a side of a RWLock,
+                    readers run in parallel, a writer runs alone.
+                    methods sharing lock_name must all have a mode, or none.
+            reentrant -- use a threading.RLock, so that a locked method
+                         can call another one of the same lock. (mode must be None)
+            timeout -- seconds to wait for the lock, LockTimeout is raised after that.
+                       if None, wait forever.
         Usage:
             class Test(object):
                 @mthread_safe(lock_name='_lock1')
@@ -116,26 +242,418 @@ def mthread_safe(**options):
                 def test21(self):
                     print 'test21'
 
+                @mthread_safe(lock_name='rwlock', mode='read', timeout=1)
+                def test31(self):
+                    print 'test31'
+
     """
+    lock_name = options.get('lock_name', '_thread_lock_')
+    mode = options.get('mode')
+    reentrant = bool(options.get('reentrant', False))
+    timeout = options.get('timeout')
+
+    assert mode in (None, 'read', 'write'), 'unknown mode: %s' % mode
+    assert not (mode and reentrant), 'RWLock is not re-entrant'
+    if mode:
+        factory, lock_type, type_name = RWLock, RWLock, 'RWLock'
+    elif reentrant:
+        factory, lock_type, type_name = threading.RLock, _RLockType, 'threading.RLock'
+    else:
+        factory, lock_type, type_name = threading.Lock, thread.LockType, 'threading.Lock'
 
     def decorator(method):
-        lock_name = options.get('lock_name', '_thread_lock_')
+        @wraps(method)
         def new_method(self, *args, **kwargs):
             lock = getattr(self, lock_name, nothing)
             if lock is nothing:
-                lock = threading.Lock()
-                setattr(self, lock_name, lock)
-            assert isinstance(lock, thread.LockType), \
-                    "%s is not instance of threading.Lock, maybe a conflict" % lock_name
-
-            with lock:
+                with _creation_lock:
+                    # another thread may have created it
+                    lock = getattr(self, lock_name, nothing)
+                    if lock is nothing:
+                        lock = factory()
+                        setattr(self, lock_name, lock)
+            assert isinstance(lock, lock_type), \
+                    "%s is not instance of %s, maybe a conflict" % (lock_name, type_name)
+
+            if mode:
+                lock = lock.reader if mode == 'read' else lock.writer
+                acquired = lock.acquire(timeout)
+            else:
+                acquired = _acquire(lock, timeout)
+            if not acquired:
+                raise LockTimeout('%s is not acquired in %s seconds' % (lock_name, timeout))
+
+            try:
                 return method(self, *args, **kwargs)
+            finally:
+                lock.release()
 
         return new_method
 
     return decorator
 
 
+class _RWLockSide(object):
+    """
+        one side (reader or writer) of RWLock,
+        works like threading.Lock, acquire(timeout=None) returns False on timeout.
+    """
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
+
+
+class RWLock(object):
+    """
+        A fair reader-writer lock.
+        readers share the lock, a writer holds it exclusively.
+        new readers wait while a writer is waiting, so writers do not starve,
+        and readers waiting when a writer releases go before the next writer,
+        so readers do not starve either.
+        acquire_read and acquire_write accept a timeout, and return False on timeout.
+        not re-entrant.
+        Usage:
+            lock = RWLock()
+            with lock.reader:
+                print 'read'
+            with lock.writer:
+                print 'write'
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._readers_waiting = 0
+        self._writers_waiting = 0
+        self._read_turn = False     # readers waiting for the last writer go first
+
+        self.reader = _RWLockSide(self.acquire_read, self.release_read)
+        self.writer = _RWLockSide(self.acquire_write, self.release_write)
+
+    def _wait(self, deadline):
+        """
+            wait for a notification with self._cond held.
+            output:
+                False if the deadline is passed.
+        """
+        if deadline is None:
+            self._cond.wait()
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        self._cond.wait(remaining)
+        return True
+
+    def acquire_read(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._readers_waiting += 1
+            try:
+                while self._writer or (self._writers_waiting and not self._read_turn):
+                    if not self._wait(deadline):
+                        return False
+            finally:
+                self._readers_waiting -= 1
+                if not self._readers_waiting and self._read_turn:
+                    # all of them are in (or gave up), writers' turn
+                    self._read_turn = False
+                    self._cond.notify_all()
+            self._readers += 1
+            return True
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writer or self._readers or self._read_turn:
+                    if not self._wait(deadline):
+                        # readers may wait for this writer
+                        self._cond.notify_all()
+                        return False
+            finally:
+                self._writers_waiting -= 1
+            self._writer = True
+            return True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            if self._readers_waiting:
+                self._read_turn = True
+            self._cond.notify_all()
+
+
+class FutureTimeout(Exception):
+    pass
+
+
+class Future(object):
+    """
+        result of a call running in another thread.
+        Usage:
+            future = Future()
+            make_thread(lambda: future.set_result(42))
+            print future.result(timeout=1)    # 42
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def _wait(self, timeout):
+        with self._cond:
+            if not self._done:
+                self._cond.wait(timeout)
+            if not self._done:
+                raise FutureTimeout('not done in %s seconds' % timeout)
+
+    def result(self, timeout=None):
+        """
+            wait until done, return the result or raise the exception of the call.
+            FutureTimeout is raised if not done in `timeout` seconds.
+        """
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exc_info and self._exc_info[1]
+
+    # like a thread, for callers of threaded(pool=...)
+    def join(self, timeout=None):
+        with self._cond:
+            if not self._done:
+                self._cond.wait(timeout)
+
+    def is_alive(self):
+        return not self._done
+
+    def add_done_callback(self, callback):
+        """
+            callback(future) is called once done,
+            in the thread which completes the future, or right now if done.
+        """
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _complete(self, result, exc_info):
+        with self._cond:
+            assert not self._done, 'future is done already'
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            self._cond.notify_all()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def set_result(self, result):
+        self._complete(result, None)
+
+    def set_exception(self, exc_info):
+        """
+            input:
+                exc_info -> sys.exc_info() of the exception
+        """
+        self._complete(None, exc_info)
+
+    def run(self, func, *args, **kwargs):
+        """
+            call func and complete the future with its result or exception.
+        """
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            self.set_exception(sys.exc_info())
+        else:
+            self.set_result(result)
+
+
+class PoolFull(Exception):
+    pass
+
+
+class ThreadPool(object):
+    """
+        A pool of worker threads, running submitted calls from a work queue.
+        Usage:
+            pool = ThreadPool(4, max_queue=100)
+            future = pool.submit(sum, [1, 2])
+            print future.result()   # 3
+            pool.shutdown()
+    """
+
+    full_policies = ('block', 'drop', 'caller-runs')
+
+    def __init__(self, min_workers=4, max_workers=None, max_queue=0, full='block',
+                 idle_timeout=60, name='pool'):
+        """
+            input:
+                min_workers -> number of workers always running.
+                max_workers -> default: min_workers (fixed size).
+                               if larger, a worker is added when a call is submitted
+                               and no worker is idle, and it exits after idle_timeout
+                               seconds without work.
+                max_queue -> max number of calls waiting for a worker, 0 means unbounded.
+                full -> what submit does when the queue is full:
+                        'block' -> wait for room
+                        'drop' -> the call is dropped, its future raises PoolFull
+                        'caller-runs' -> run the call in the calling thread
+                name -> name prefix of worker threads
+        """
+        if max_workers is None:
+            max_workers = min_workers
+        assert 0 <= min_workers <= max_workers and max_workers >= 1
+        assert full in self.full_policies, 'unknown full policy: %s' % full
+
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.full = full
+        self.idle_timeout = idle_timeout
+        self.name = name
+
+        self._queue = Queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._idle = 0
+        self._shutdown = False
+        self._threads = set()
+        for _ in xrange(min_workers):
+            self._spawn()
+
+    def _spawn(self):
+        # with self._lock, or in __init__.
+        # a new worker is idle until it takes a call
+        self._workers += 1
+        self._idle += 1
+        t = threading.Thread(target=self._work, name='%s-%d' % (self.name, self._workers))
+        t.setDaemon(True)
+        self._threads.add(t)
+        t.start()
+
+    def _retire(self):
+        # with self._lock
+        self._idle -= 1
+        self._workers -= 1
+        self._threads.discard(threading.current_thread())
+
+    def _work(self):
+        while True:
+            with self._lock:
+                extra = self._workers > self.min_workers
+            try:
+                task = self._queue.get(True, self.idle_timeout) if extra else self._queue.get()
+            except Queue.Empty:
+                with self._lock:
+                    # decided with the lock held, a call queued by now is not left behind,
+                    # submit() checks for idle workers after queuing a call.
+                    if not self._queue.qsize() and self._workers > self.min_workers:
+                        self._retire()
+                        return
+                continue
+
+            with self._lock:
+                if task is None:
+                    # shutdown
+                    self._retire()
+                    return
+                self._idle -= 1
+
+            future, func, args, kwargs = task
+            future.run(func, *args, **kwargs)
+
+            with self._lock:
+                self._idle += 1
+
+    def _grow(self, queued):
+        """
+            add a worker if queued calls (and the one not queued for a full queue)
+            are more than idle workers. with self._lock.
+        """
+        waiting = self._queue.qsize() + (0 if queued else 1)
+        if self._idle < waiting and self._workers < self.max_workers:
+            self._spawn()
+
+    def submit(self, func, *args, **kwargs):
+        """
+            output:
+                Future of func(*args, **kwargs)
+        """
+        future = Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('thread pool is shut down')
+
+        task = (future, func, args, kwargs)
+        try:
+            self._queue.put(task, False)
+            queued = True
+        except Queue.Full:
+            queued = False
+        with self._lock:
+            self._grow(queued)
+
+        if queued:
+            return future
+        if self.full == 'block':
+            self._queue.put(task)
+        elif self.full == 'drop':
+            try:
+                raise PoolFull('work queue of %s is full' % self.name)
+            except PoolFull:
+                future.set_exception(sys.exc_info())
+        else:
+            future.run(func, *args, **kwargs)
+        return future
+
+    def map(self, func, *iterables):
+        """
+            like map, calls run in the pool.
+        """
+        futures = [self.submit(func, *args) for args in zip(*iterables)]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        """
+            stop workers after submitted calls are done.
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            threads = list(self._threads)
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for t in threads:
+                t.join()
+
+
 class Flag(object):
     """
         A flag indicate true or false.
@@ -159,6 +677,246 @@ class Flag(object):
 
 
 
+#########################
+# unit tests
+#########################
+
+import unittest
+
+class TestThreadPool(unittest.TestCase):
+    def test_submit(self):
+        pool = ThreadPool(2)
+        self.assertEqual(pool.submit(sum, [1, 2]).result(timeout=5), 3)
+        self.assertEqual(pool.map(lambda a, b: a + b, [1, 2, 3], [4, 5, 6]), [5, 7, 9])
+        self.assertRaises(ZeroDivisionError, pool.submit(lambda: 1 / 0).result, 5)
+
+        @threaded(pool=pool)
+        def double(x):
+            return x * 2
+        future = double(4)
+        future.join()
+        self.assertFalse(future.is_alive())
+        self.assertEqual(future.result(), 8)
+        pool.shutdown()
+
+    def test_block(self):
+        pool = ThreadPool(1, max_queue=1)
+        gate = threading.Event()
+        futures = [pool.submit(gate.wait) for _ in range(2)]
+
+        # the queue is full, submit blocks until a call is taken
+        blocked = make_thread(pool.submit, args=(sum, [1]))
+        time.sleep(0.1)
+        self.assertTrue(blocked.is_alive())
+        gate.set()
+        blocked.join(5)
+        self.assertEqual(blocked.result().result(timeout=5), 1)
+        self.assertTrue(all(f.result(timeout=5) is not False for f in futures))
+        pool.shutdown()
+
+    def test_drop(self):
+        pool = ThreadPool(1, max_queue=1, full='drop')
+        gate = threading.Event()
+        running = pool.submit(gate.wait)
+        time.sleep(0.05)
+        queued = pool.submit(sum, [1])
+        dropped = pool.submit(sum, [2])
+        self.assertRaises(PoolFull, dropped.result, 1)
+        gate.set()
+        self.assertEqual(queued.result(timeout=5), 1)
+        running.result(timeout=5)
+        pool.shutdown()
+
+    def test_caller_runs(self):
+        pool = ThreadPool(1, max_queue=1, full='caller-runs')
+        gate = threading.Event()
+        pool.submit(gate.wait)
+        time.sleep(0.05)
+        current = lambda: threading.current_thread().name
+        queued = pool.submit(current)
+        self.assertEqual(pool.submit(current).result(timeout=0), threading.current_thread().name)
+        gate.set()
+        self.assertEqual(queued.result(timeout=5), 'pool-1')
+        pool.shutdown()
+
+    def test_elastic(self):
+        pool = ThreadPool(1, max_workers=3, idle_timeout=0.1)
+        gate = threading.Event()
+        futures = [pool.submit(gate.wait) for _ in range(5)]
+        self.assertEqual(pool._workers, 3)
+        gate.set()
+        for future in futures:
+            future.result(timeout=5)
+
+        # extra workers exit after idle_timeout
+        time.sleep(0.5)
+        self.assertEqual(pool._workers, 1)
+        self.assertEqual(pool.submit(sum, [1]).result(timeout=5), 1)
+        pool.shutdown()
+
+    def test_retiring_worker(self):
+        # calls submitted while the only worker retires are not left behind
+        pool = ThreadPool(0, max_workers=1, idle_timeout=0.01)
+        for i in range(100):
+            self.assertEqual(pool.submit(sum, [i]).result(timeout=5), i)
+            time.sleep(0.01 * (i % 3))
+        pool.shutdown()
+
+    def test_shutdown(self):
+        pool = ThreadPool(2, max_workers=4)
+        futures = [pool.submit(time.sleep, 0.05) for _ in range(6)]
+        threads = list(pool._threads)
+        pool.shutdown()
+        # submitted calls are done first
+        self.assertTrue(all(f.done() for f in futures))
+        self.assertFalse(any(t.is_alive() for t in threads))
+        self.assertEqual(pool._workers, 0)
+        self.assertRaises(RuntimeError, pool.submit, sum, [1])
+
+
+class TestMthreadSafe(unittest.TestCase):
+    class Resource(object):
+        def __init__(self):
+            self.active = []        # (kind, number of callers inside) on entry
+            self.inside = 0
+            self.counter = threading.Lock()
+
+        def _enter(self, kind, delay):
+            with self.counter:
+                self.inside += 1
+                self.active.append((kind, self.inside))
+            time.sleep(delay)
+            with self.counter:
+                self.inside -= 1
+
+        @mthread_safe(timeout=0.05)
+        def hold(self, event):
+            event.wait()
+
+        @mthread_safe(reentrant=True, lock_name='_rlock')
+        def outer(self):
+            return self.inner()
+
+        @mthread_safe(reentrant=True, lock_name='_rlock')
+        def inner(self):
+            return 'inner'
+
+        @mthread_safe(lock_name='_rw', mode='read', timeout=0.05)
+        def read(self, delay=0.1):
+            self._enter('read', delay)
+
+        @mthread_safe(lock_name='_rw', mode='write', timeout=5)
+        def write(self, delay=0.05):
+            self._enter('write', delay)
+
+        @mthread_safe(lock_name='_rw')
+        def plain(self):
+            pass
+
+    def test_timeout(self):
+        res = self.Resource()
+        event = threading.Event()
+        holder = make_thread(res.hold, args=(event, ))
+        time.sleep(0.05)
+        self.assertRaises(LockTimeout, res.hold, event)
+        event.set()
+        holder.join(5)
+        res.hold(event)
+
+        # a reader gives up while a writer holds the lock
+        writer = make_thread(res.write, kwargs={'delay': 0.3})
+        time.sleep(0.05)
+        self.assertRaises(LockTimeout, res.read)
+        writer.join(5)
+
+    def test_reentrant(self):
+        self.assertEqual(self.Resource().outer(), 'inner')
+
+    def test_read_write(self):
+        res = self.Resource()
+        readers = [make_thread(res.read) for _ in range(3)]
+        wait_all(readers, timeout=5)
+        # readers run in parallel
+        self.assertEqual(max(n for kind, n in res.active), 3)
+
+        res.active = []
+        threads = [make_thread(res.write) for _ in range(3)]
+        wait_all(threads, timeout=5)
+        # a writer runs alone
+        self.assertEqual(res.active, [('write', 1)] * 3)
+
+    def test_writer_not_starved(self):
+        lock = RWLock()
+        stop = threading.Event()
+
+        def read():
+            while not stop.is_set():
+                with lock.reader:
+                    time.sleep(0.01)
+
+        readers = [make_thread(read) for _ in range(4)]
+        time.sleep(0.05)
+        # readers always overlap, a writer still gets in
+        self.assertTrue(lock.acquire_write(timeout=1))
+        lock.release_write()
+        stop.set()
+        self.assertTrue(wait_all(readers, timeout=5))
+
+    def test_lock_type(self):
+        res = self.Resource()
+        res.read(0)
+        # '_rw' is a RWLock, a method without mode conflicts with it
+        self.assertRaises(AssertionError, res.plain)
+
+
+class TestWait(unittest.TestCase):
+    def test_wait_all(self):
+        gate = threading.Event()
+        plain = threading.Thread(target=gate.wait)
+        plain.start()
+        tasks = [
+            make_thread(time.sleep, args=(0.05, )),
+            plain,
+            Future(),
+            threading.Thread(target=sum),                   # not started
+            make_thread(sum, args=([1], ), start=False),    # not started
+        ]
+        tasks[2].set_result(1)
+
+        begin = time.time()
+        self.assertFalse(wait_all(tasks, timeout=0.1))
+        gate.set()
+        self.assertTrue(wait_all(tasks, timeout=5))
+        self.assertTrue(wait_threads(tasks[-2:], timeout=5))
+        self.assertTrue(time.time() - begin < 1)
+
+    def test_wait_any(self):
+        gate = threading.Event()
+        slow = make_thread(gate.wait)
+        fast = make_thread(sum, args=([1, 2], ))
+        self.assertTrue(wait_any([slow, fast], timeout=5) is fast)
+        self.assertEqual(fast.result(), 3)
+
+        self.assertEqual(wait_any([slow], timeout=0.05), None)
+        gate.set()
+        self.assertTrue(wait_any([slow], timeout=5) is slow)
+        self.assertEqual(wait_any([], timeout=0.05), None)
+
+    def test_as_completed(self):
+        pool = ThreadPool(3)
+        futures = [pool.submit(time.sleep, delay) for delay in (0.2, 0.0, 0.1)]
+        self.assertEqual(list(as_completed(futures, timeout=5)), [futures[1], futures[2], futures[0]])
+
+        gate = threading.Event()
+        blocked = pool.submit(gate.wait)
+        done = pool.submit(sum, [1])
+        completed = as_completed([blocked, done], timeout=0.1)
+        self.assertTrue(next(completed) is done)
+        self.assertRaises(FutureTimeout, next, completed)
+        gate.set()
+        pool.shutdown()
+
+
 if __name__ == '__main__':
     print 'main thread id:', threading.current_thread().ident
     @threaded()
@@ -167,3 +925,5 @@ if __name__ == '__main__':
 
     test_t = test()
     test_t.join()
+
+    unittest.main()